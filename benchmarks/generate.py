@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+"""
+Generates synthetic inputs shaped like the Juan Bohon sheets:
+a title row, headers split over two rows, numbered NOTA / % ASISTENCIA
+blocks and a legend at the bottom.
+
+Workbooks are written with xlwt when it is installed. Otherwise the csv
+files the Splitter would have made from them are written instead.
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import easyio
+
+try:
+    import xlwt
+except ImportError:
+    xlwt = None
+
+
+FIXED_COLUMNS = [u'RUT',
+                 u'APELLIDO PATERNO',
+                 u'APELLIDO MATERNO',
+                 u'NOMBRE']
+
+IGNORE_COLUMNS = [u'Nº']
+
+REMOVE_CONTENT = [u'Y = RETIRADO',
+                  u'S = SITUACION PENDIENTE',
+                  u'R = REPROBADOS',
+                  u'P = APROBADO',
+                  u'LA SERENA',
+                  u'Observaciones:']
+
+NEW_COLUMNS_REGEX = '(?<=- )\d+(?=.csv)'
+
+
+def merge_columns(width):
+    """
+    Gets the NOTA / % ASISTENCIA columns for sheets of the given width
+    """
+    columns = []
+    for block in range(1, (width - 5) // 2 + 1):
+        columns.extend([u'%d NOTA' % block, u'%d %% ASISTENCIA' % block])
+
+    return columns
+
+
+def build_sheet(rng, identifiers, rows, width, new_column):
+    """
+    Gets the rows of a synthetic sheet
+    """
+    grades = merge_columns(width)
+
+    title = [u'LA SERENA'] + [u''] * (4 + len(grades))
+    first = [u'Nº', u'RUT', u'APELLIDO', u'APELLIDO', u'NOMBRE'] + grades
+    second = [u'', u'', u'PATERNO', u'MATERNO', u''] + [u''] * len(grades)
+    if new_column is not None:
+        title.append(u'')
+        first.append(new_column)
+        second.append(u'')
+
+    sheet = [title, first, second]
+    for i in range(rows):
+        identifier = rng.choice(identifiers)
+        row = [unicode(i + 1),
+               unicode(identifier),
+               u'PATERNO %d' % identifier,
+               u'MATERNO %d' % identifier,
+               u'NOMBRE %d' % identifier]
+        for grade in grades:
+            row.append(rng.choice([u'', u'4.5', u'5.5', u'6.8', u'90']))
+        if new_column is not None:
+            row.append(rng.choice([u'', u'X']))
+        sheet.append(row)
+
+    sheet.append([u''] * len(first))
+    sheet.append([u'Y = RETIRADO', u'P = APROBADO'] +
+                 [u''] * (len(first) - 2))
+    return sheet
+
+
+def generate(folder,
+             workbooks=4,
+             sheets=3,
+             rows=500,
+             width=19,
+             duplicates=0.3,
+             new_columns=0.1,
+             seed=0,
+             excel=None):
+    """
+    Writes workbooks (or their csv sheets) to folder.
+
+    rows is the number of data rows per sheet, width the number of
+    columns, duplicates the share of rows whose identifier is repeated
+    and new_columns the share of sheets with an extra column of their own.
+
+    Returns whether workbooks were written.
+    """
+    if excel is None:
+        excel = xlwt is not None
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    rng = random.Random(seed)
+    total = workbooks * sheets * rows
+    identifiers = range(1, max(1, int(total * (1 - duplicates))) + 1)
+
+    for w in range(workbooks):
+        name = os.path.join(folder, u'CUR%d%d' % (w % 2 + 1, 2010 + w))
+        book = xlwt.Workbook() if excel else None
+
+        for s in range(sheets):
+            new_column = None
+            if rng.random() < new_columns:
+                new_column = u'EXTRA %d %d' % (w, s)
+            sheet = build_sheet(rng, identifiers, rows, width, new_column)
+
+            if excel:
+                page = book.add_sheet(u'Sheet %d' % s)
+                for i, row in enumerate(sheet):
+                    for j, value in enumerate(row):
+                        page.write(i, j, value)
+            else:
+                with easyio.Writer(u'%s - %d.csv' % (name, s)) as writer:
+                    for row in sheet:
+                        writer.write_row(row)
+
+        if excel:
+            book.save(name + u'.xls')
+
+    return excel
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('folder', help='Folder to write the inputs to')
+
+    parser.add_argument('--workbooks', type=int, default=4)
+    parser.add_argument('--sheets', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--width', type=int, default=19)
+    parser.add_argument('--duplicates', type=float, default=0.3)
+    parser.add_argument('--new_columns', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    generate(args.folder,
+             args.workbooks, args.sheets, args.rows, args.width,
+             args.duplicates, args.new_columns, args.seed)
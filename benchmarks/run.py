@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+"""
+Times every stage on synthetic inputs from generate.py:
+Splitter.split_folder, each Editor step, Merger.merge_files and
+process.process, with their rows per second and peak memory.
+
+Results can be saved as a JSON baseline, and later runs compared
+against it to catch regressions.
+"""
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import easyio
+import editor
+import generate
+import merger
+
+try:
+    import splitter
+    import process
+except ImportError:
+    splitter = None
+    process = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+def measure(function, finish=None):
+    """
+    Runs function and gets the seconds it took, and its peak memory
+    in bytes. finish, if given, is run right after it without being
+    measured (to leave what the next stage reads).
+
+    With tracemalloc, the peak is the most memory allocated at once.
+    Without it (Python 2), both are run in a forked process, so the
+    peak is the largest resident size of that process only, and not of
+    the stages before. Where there is no fork either, the peak is the
+    largest resident size of the whole process so far.
+    """
+    if tracemalloc is None and hasattr(os, 'fork'):
+        return _measure_forked(function, finish)
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+    start = time.time()
+    function()
+    seconds = time.time() - start
+
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if finish is not None:
+        finish()
+
+    return seconds, peak
+
+
+def _measure_forked(function, finish):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 1
+        try:
+            start = time.time()
+            function()
+            seconds = time.time() - start
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+            if finish is not None:
+                finish()
+
+            os.write(write_end, json.dumps([seconds, peak]).encode('ascii'))
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as f:
+        data = f.read()
+
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('The measured stage failed')
+
+    seconds, peak = json.loads(data.decode('ascii'))
+    return seconds, peak
+
+
+def result(seconds, peak, rows):
+    return collections.OrderedDict([
+        ('seconds', round(seconds, 4)),
+        ('rows', rows),
+        ('rows_per_second', round(rows / seconds, 1) if seconds > 0 else 0),
+        ('peak_bytes', peak)])
+
+
+def build_editor():
+    """
+    Gets an Editor set up the way process.process sets it up
+    """
+    ed = editor.Editor()
+    ed.remove_content_in_processing(generate.REMOVE_CONTENT)
+    ed.remove_empty_columns_in_processing()
+    ed.trim_in_processing()
+    ed.expand_rows_in_processing()
+    ed.collapse_headers_in_processing(
+        generate.FIXED_COLUMNS, [], generate.IGNORE_COLUMNS)
+    return ed
+
+
+def build_merger(width):
+    return merger.Merger(fixed_columns=generate.FIXED_COLUMNS,
+                         ignore_columns=generate.IGNORE_COLUMNS,
+                         merge_columns=generate.merge_columns(width),
+                         expect_new_columns=True,
+                         new_columns_regex=generate.NEW_COLUMNS_REGEX)
+
+
+def run(folder, settings):
+    """
+    Generates the inputs in folder and times every stage.
+    Returns an OrderedDict (stage -> result).
+    """
+    results = collections.OrderedDict()
+    excel = generate.generate(folder, **settings)
+    total_rows = settings['workbooks'] * settings['sheets'] * settings['rows']
+
+    if excel and splitter is not None:
+        sp = splitter.Splitter()
+        seconds, peak = measure(lambda: sp.split_folder(folder))
+        results['split_folder'] = result(seconds, peak, total_rows)
+
+    # Editor, one step at a time over all files. Every step leaves its
+    # rows in the files, as it may run in another process.
+    ed = build_editor()
+    files = easyio.get_files(folder, '.csv')
+
+    for step in ed.processing_steps:
+        sheets = collections.OrderedDict(
+            (path, ed.read(path)) for path in files)
+
+        def apply_step():
+            for path in sheets:
+                sheets[path] = getattr(ed, step.name)(
+                    path, sheets[path], *step.args)
+
+        def write_sheets():
+            for path in sheets:
+                ed.write(path, sheets[path])
+
+        rows = sum([len(rows) for rows in sheets.values()])
+        seconds, peak = measure(apply_step, write_sheets)
+        results['editor' + step.name] = result(seconds, peak, rows)
+
+    # Merger
+    output = os.path.join(folder, 'output.csv')
+    mg = build_merger(settings['width'])
+    seconds, peak = measure(lambda: mg.merge_files(files, output))
+    results['merge_files'] = result(seconds, peak, total_rows)
+
+    # Everything, from the workbooks
+    if excel and process is not None:
+        easyio.remove(files + [output])
+
+        def run_process():
+            process.process([folder], output,
+                            generate.FIXED_COLUMNS,
+                            generate.merge_columns(settings['width']),
+                            generate.IGNORE_COLUMNS,
+                            generate.REMOVE_CONTENT,
+                            {}, [], True, generate.NEW_COLUMNS_REGEX)
+
+        seconds, peak = measure(run_process)
+        results['process'] = result(seconds, peak, total_rows)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Gets the stages whose rows per second dropped by more than tolerance
+    (a fraction) from the baseline
+
+    >>> baseline = {'a': {'rows_per_second': 100}}
+    >>> compare({'a': {'rows_per_second': 70}}, baseline, 0.2)
+    [('a', 100, 70)]
+    >>> compare({'a': {'rows_per_second': 90}}, baseline, 0.2)
+    []
+    """
+    regressions = []
+    for stage in results:
+        if stage not in baseline:
+            continue
+
+        before = baseline[stage]['rows_per_second']
+        after = results[stage]['rows_per_second']
+        if after < before * (1 - tolerance):
+            regressions.append((stage, before, after))
+
+    return regressions
+
+
+def report(results):
+    print('%-32s %10s %10s %14s %10s' %
+          ('stage', 'seconds', 'rows', 'rows/sec', 'peak MB'))
+    for stage, values in results.items():
+        print('%-32s %10.3f %10d %14.1f %10.1f' %
+              (stage,
+               values['seconds'],
+               values['rows'],
+               values['rows_per_second'],
+               values['peak_bytes'] / float(1 << 20)))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--folder',
+                        help='Folder for the inputs (removed afterwards '
+                             'unless given)',
+                        default=None)
+    parser.add_argument('--workbooks', type=int, default=4)
+    parser.add_argument('--sheets', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--width', type=int, default=19)
+    parser.add_argument('--duplicates', type=float, default=0.3)
+    parser.add_argument('--new_columns', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+
+    parser.add_argument('--save',
+                        help='Save the results as a JSON baseline',
+                        default=None)
+    parser.add_argument('--baseline',
+                        help='JSON baseline to compare the results with',
+                        default=None)
+    parser.add_argument('--tolerance',
+                        help='Drop in rows/sec taken as a regression',
+                        type=float,
+                        default=0.2)
+
+    args = parser.parse_args()
+    settings = collections.OrderedDict([
+        ('workbooks', args.workbooks),
+        ('sheets', args.sheets),
+        ('rows', args.rows),
+        ('width', args.width),
+        ('duplicates', args.duplicates),
+        ('new_columns', args.new_columns),
+        ('seed', args.seed)])
+
+    folder = args.folder or tempfile.mkdtemp()
+    try:
+        results = run(folder, settings)
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder)
+
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline['settings'] != settings:
+            print('The baseline was run with other settings')
+
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for stage, before, after in regressions:
+            print('REGRESSION %s: %.1f -> %.1f rows/sec' %
+                  (stage, before, after))
+
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import hashlib
+import itertools
+import manifest
+import marshal
+import operator
+import os
+import struct
+import tempfile
+import zlib
+
+# Changes whenever the entries are written differently
+VERSION = 1
+
+
+class WorkbookCache:
+    """
+    Keeps the sheet rows read from workbooks in a folder, under a key
+    made from the content of the workbook and the settings used to read it.
+    Entries are compressed marshal records, read back one row at a time.
+
+    When the entries take more than max_bytes, the least recently used
+    ones are removed.
+
+    >>> import tempfile
+    >>> cache = WorkbookCache(tempfile.mkdtemp())
+    >>> sheets = [(0, iter([[u'a', u'b'], [u'1', u'2']])),
+    ...           (2, iter([[u'c']]))]
+    >>> for index, rows in cache.write('key', sheets):
+    ...     print(index, list(rows))
+    (0, [[u'a', u'b'], [u'1', u'2']])
+    (2, [[u'c']])
+    >>> [(index, list(rows)) for index, rows in cache.read('key')]
+    [(0, [[u'a', u'b'], [u'1', u'2']]), (2, [[u'c']])]
+    >>> cache.read('other') is None
+    True
+    """
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, path, *settings):
+        """
+        Gets the key of a workbook read with the given settings
+        """
+        digest = hashlib.sha1(manifest.file_hash(path))
+        digest.update(repr((VERSION,) + settings))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def read(self, key):
+        """
+        Gets the (sheet index, rows) kept for a key, or None if there
+        is no entry for it.
+        As with the sheets of a workbook, the rows of a sheet must be used
+        before moving on to the next one.
+        """
+        path = self.entry_path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        # Marks the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return _iter_sheets(f)
+
+    def write(self, key, sheets):
+        """
+        Yields the (sheet index, rows) of sheets as they are,
+        keeping them for key on the way.
+        The entry is only kept if every row of every sheet is read.
+        """
+        handle, temporary_path = tempfile.mkstemp(
+            prefix=key + '.', suffix='.tmp', dir=self.directory)
+        f = os.fdopen(handle, 'wb')
+        compressor = zlib.compressobj()
+        finished = []
+        written = False
+
+        def write_record(record):
+            data = marshal.dumps(record)
+            f.write(compressor.compress(struct.pack('<I', len(data)) + data))
+
+        def store_rows(index, rows):
+            for row in rows:
+                write_record((index, row))
+                yield row
+            finished.append(index)
+
+        try:
+            count = 0
+            for index, rows in sheets:
+                count += 1
+                yield index, store_rows(index, rows)
+
+            if len(finished) == count:
+                f.write(compressor.flush())
+                f.close()
+
+                path = self.entry_path(key)
+                if os.name == 'nt' and os.path.exists(path):
+                    os.remove(path)
+                os.rename(temporary_path, path)
+                written = True
+        finally:
+            if not written:
+                f.close()
+                os.remove(temporary_path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until they all
+        take at most max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.cache'):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum([size for mtime, size, path in entries])
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            # Other processes may be evicting it too
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def _iter_sheets(f):
+    with f:
+        records = _iter_records(f)
+        for index, group in itertools.groupby(records,
+                                              operator.itemgetter(0)):
+            yield index, (row for index, row in group)
+
+
+def _iter_records(f):
+    data = b''
+    for chunk in _iter_decompressed(f):
+        data += chunk
+
+        offset = 0
+        while len(data) - offset >= 4:
+            size, = struct.unpack_from('<I', data, offset)
+            end = offset + 4 + size
+            if end > len(data):
+                break
+
+            yield marshal.loads(data[offset + 4:end])
+            offset = end
+
+        data = data[offset:]
+
+
+def _iter_decompressed(f, chunk_size=1 << 16):
+    decompressor = zlib.decompressobj()
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        yield decompressor.decompress(chunk)
+
+    yield decompressor.flush()
+
+
+def test():
+    print('Testing...')
+    import doctest
+    doctest.testmod()
+    print('Done')
+
+
+if __name__ == '__main__':
+    test()
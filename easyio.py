@@ -1,30 +1,144 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
 import codecs
+import csv
+import fnmatch
+import io
+import itertools
+import mmap
 import os
 import ntpath
+import struct
+import tempfile
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-def get_files(path, extensions='*'):
+# Extension and first bytes of the files written by RowsWriter
+ROWS_EXTENSION = '.rows'
+ROWS_HEADER = b'ESMROWS\x01'
+
+# Files from this size on are mapped to memory instead of read
+MMAP_THRESHOLD = 1 << 20
+
+
+def get_files(path, extensions='*', skip=(), stats=None, **options):
     """
-    Gets the paths to files in a given path
+    Gets the paths to files in a given path, in the order os.walk
+    finds them (see iter_files for the options).
+    Files in skip are left out.
+    With a stats dictionary, the stat of every file is kept in it
+    by path, for later use.
     """
-    if path[-1] is not '/' and path[-1] is not '\\':
+    skip = set([os.path.normpath(x) for x in skip])
+
+    files = []
+    for entry in iter_files(path, extensions, **options):
+        if len(skip) > 0 and os.path.normpath(entry.path) in skip:
+            continue
+
+        files.append(entry.path)
+        if stats is not None:
+            stats[entry.path] = entry.stat()
+
+    return files
+
+
+def iter_files(path, extensions='*', patterns=None,
+               skip_directories=(), hidden=False):
+    """
+    Yields the files in a given path, one at a time, as os.scandir
+    entries (with path, name and a cached stat()).
+    Python 2 has no os.scandir: there, the scandir package (pip install
+    scandir) is used if installed, and os.listdir with one stat per
+    entry otherwise.
+
+    Only files with one of the extensions ('*' for any) whose name
+    matches one of the glob patterns, if given, are found.
+    Folders in skip_directories, and hidden ones (starting with '.')
+    unless hidden is set, are not looked into.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for folder in ['sub', '.git']:
+    ...     os.mkdir(os.path.join(root, folder))
+    >>> for name in ['a.csv', 'b.txt', 'sub/c.csv', '.git/d.csv']:
+    ...     write_file(os.path.join(root, name), u'')
+    >>> sorted([entry.name for entry in iter_files(root, '.csv')])
+    ['a.csv', 'c.csv']
+    >>> [entry.name for entry in iter_files(root, patterns=['b*'])]
+    ['b.txt']
+    """
+    if path[-1] not in '/\\':
         path = path + '/'
 
     if isinstance(extensions, str) or isinstance(extensions, unicode):
         extensions = [extensions]
+    extensions = set(extensions)
+
+    skip_directories = set([os.path.normpath(directory)
+                            for directory in skip_directories])
+
+    directories = [path]
+    while len(directories) > 0:
+        directory = directories.pop()
+
+        subdirectories = []
+        for entry in _scan(directory):
+            if entry.is_dir():
+                if entry.is_symlink() or\
+                        (not hidden and entry.name.startswith('.')) or\
+                        os.path.normpath(entry.path) in skip_directories:
+                    continue
 
-    all_files = [os.path.join(root, filename)
-                 for root, dirnames, filenames in os.walk(path)
-                 for filename in filenames]
+                subdirectories.append(entry.path)
+                continue
 
-    filtered_files = [
-        filename for filename in all_files
-        if get_extension(filename) in extensions or '*' in extensions
-    ]
+            if '*' not in extensions and\
+                    get_extension(entry.name) not in extensions:
+                continue
 
-    return filtered_files
+            if patterns is not None and\
+                    not any([fnmatch.fnmatch(entry.name, pattern)
+                             for pattern in patterns]):
+                continue
+
+            yield entry
+
+        # Folders are looked into in the order they were found
+        directories.extend(reversed(subdirectories))
+
+
+def _scan(directory):
+    if scandir is not None:
+        return scandir(directory)
+
+    return [_Entry(directory, name) for name in os.listdir(directory)]
+
+
+class _Entry:
+    # What iter_files uses of the entries of os.scandir
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+
+        return self._stat
 
 
 def path_leaf(path):
@@ -54,6 +168,156 @@ def write_file(path, content):
         f.write(content)
 
 
+class Writer:
+    """
+    Writes text to a file as it comes, keeping up to buffer_size
+    characters in memory.
+    The file is written under a temporary name next to path, and only
+    renamed to path on close, so path is never left half written.
+
+    Use it in a with block to have it closed, or removed on errors
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'file.csv')
+    >>> with Writer(path) as writer:
+    ...     writer.write_row(['a', 'b'])
+    ...     writer.write_row(['1', '2'])
+    >>> read_file(path)
+    u'"a","b"\\n"1","2"'
+    """
+    # Joins the buffered pieces
+    empty = u''
+
+    def __init__(self, path, encoding='utf-8', buffer_size=1 << 16):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.lines = 0
+
+        directory, name = os.path.split(os.path.abspath(path))
+        handle, self.temporary_path = tempfile.mkstemp(
+            prefix=name + '.', suffix='.tmp', dir=directory)
+        self.file = self.open(handle, encoding)
+
+    def open(self, handle, encoding):
+        return io.open(handle, 'w', encoding=encoding, newline='')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, trace):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, text):
+        """
+        Writes text to the file
+        """
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_line(self, line):
+        """
+        Writes a line, separated with a new line from the previous one
+        """
+        if self.lines > 0:
+            self.write(u'\n')
+
+        self.write(line)
+        self.lines += 1
+
+    def write_row(self, data, separator=','):
+        """
+        Writes data as a line of CSV, quoted like merge does
+        """
+        self.write_line(merge(data, separator))
+
+    def flush(self):
+        """
+        Writes the buffered text to the file
+        """
+        if len(self.buffer) > 0:
+            self.file.write(self.empty.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        """
+        Writes everything left and moves the file to its path
+        """
+        self.flush()
+        self.file.close()
+
+        # mkstemp leaves the file readable only by its owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.temporary_path, 0o666 & ~umask)
+
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.temporary_path, self.path)
+
+    def abort(self):
+        """
+        Closes and removes the file without moving it to its path
+        """
+        self.file.close()
+        os.remove(self.temporary_path)
+
+
+class RowsWriter(Writer):
+    """
+    Writes rows to a file like Writer, in a binary format
+    which needs no quoting or parsing.
+
+    After ROWS_HEADER, every row is its number of fields and the length of
+    each one in bytes (all as 32 bit unsigned integers), then its fields
+    encoded in UTF-8. Read them with iter_binary_rows.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'file.rows')
+    >>> with RowsWriter(path) as writer:
+    ...     writer.write_row([u'a,"b"', u'c\\nd'])
+    ...     writer.write_row([])
+    ...     writer.write_row([u'\\xf1', u''])
+    >>> list(iter_binary_rows(path))
+    [[u'a,"b"', u'c\\nd'], [], [u'\\xf1', u'']]
+    """
+    empty = b''
+
+    def open(self, handle, encoding):
+        f = io.open(handle, 'wb')
+        f.write(ROWS_HEADER)
+        return f
+
+    def write_row(self, data, separator=None):
+        """
+        Writes a row. The separator is only taken to be used like Writer
+        """
+        fields = [unicode(x).encode('utf-8') for x in data]
+        lengths = [len(field) for field in fields]
+
+        self.write(struct.pack('<%dI' % (len(fields) + 1),
+                               len(fields), *lengths))
+        self.write(b''.join(fields))
+        self.lines += 1
+
+
+def open_writer(path, encoding='utf-8'):
+    """
+    Gets a RowsWriter for paths with ROWS_EXTENSION, or else a Writer
+    """
+    if get_extension(path) == ROWS_EXTENSION:
+        return RowsWriter(path)
+
+    return Writer(path, encoding)
+
+
 def read_file(path):
     """
     Retrieves the content of a file
@@ -64,6 +328,129 @@ def read_file(path):
     return text
 
 
+def iter_mapped_lines(path, encoding=None, threshold=MMAP_THRESHOLD):
+    """
+    Yields the lines of a file as content.split('\\n') would,
+    without the '\\r' of '\\r\\n' line endings.
+
+    Files of threshold bytes or more are mapped to memory, and only
+    one line at a time is copied and decoded.
+    Without an encoding, it is sniffed from the start of the file.
+    Lines which are not valid in it are read as latin-1.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'file.csv')
+    >>> with open(path, 'wb') as f:
+    ...     f.write(b'a,\\xf1\\r\\nb\\n')
+    >>> list(iter_mapped_lines(path, threshold=0))
+    [u'a,\\xf1', u'b', u'']
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0 and size >= threshold:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+
+    try:
+        if encoding is None:
+            encoding = sniff_encoding(data)
+
+        start = 0
+        if encoding == 'utf-8-sig':
+            start = len(codecs.BOM_UTF8)
+            encoding = 'utf-8'
+
+        while start <= size:
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = size
+
+            line = data[start:end]
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            start = end + 1
+
+            try:
+                line = line.decode(encoding)
+            except UnicodeDecodeError:
+                line = line.decode('latin-1')
+
+            yield line
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def sniff_encoding(data, size=1 << 12):
+    """
+    Guesses the encoding of the bytes of a file from the first
+    size of them: utf-8-sig if they start with its BOM, utf-8 if they
+    are valid UTF-8, and latin-1 otherwise
+
+    >>> sniff_encoding(b'\\xef\\xbb\\xbfa')
+    'utf-8-sig'
+    >>> sniff_encoding(u'\\xf1'.encode('utf-8'))
+    'utf-8'
+    >>> sniff_encoding(u'\\xf1'.encode('latin-1'))
+    'latin-1'
+    """
+    head = data[:size]
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+
+    # A character cut at the end of head is not an error
+    final = len(head) == len(data)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final)
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+    return 'utf-8'
+
+
+def iter_binary_rows(path):
+    """
+    Yields the rows of a file written by RowsWriter.
+    The file is mapped to memory, and every field decoded
+    straight from it.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if data[:len(ROWS_HEADER)] != ROWS_HEADER:
+            raise ValueError('%s is not a rows file' % path)
+
+        position = len(ROWS_HEADER)
+        end = len(data)
+        while position < end:
+            count, = struct.unpack_from('<I', data, position)
+            lengths = struct.unpack_from('<%dI' % count, data, position + 4)
+            position += 4 * (count + 1)
+
+            row = []
+            for length in lengths:
+                row.append(codecs.utf_8_decode(
+                    buffer(data, position, length), 'strict', True)[0])
+                position += length
+
+            yield row
+    finally:
+        data.close()
+
+
+def read_rows(path, separator=',', use_csv=False):
+    """
+    Yields the rows of a file, either CSV (parsed as iter_rows does)
+    or written by RowsWriter (with ROWS_EXTENSION)
+    """
+    if get_extension(path) == ROWS_EXTENSION:
+        return iter_binary_rows(path)
+
+    return iter_rows(iter_mapped_lines(path), separator, use_csv=use_csv)
+
+
 def flatten(arr, separator=','):
     """
     Flattens arrays of arrays of arrays.....
@@ -105,28 +492,162 @@ def unquote(data):
     return data
 
 
-def _next_term(line, separator=',', quote='"'):
-    if line[0] == quote:
-        end = line.index(quote, 1)
-        term = line[1:end]
+def iter_fields(line, separator=',', quote='"'):
+    """
+    Yields the unquoted values of a line of CSV in a single pass.
+    Doubled quotes inside a quoted value are read as one quote.
 
-        if separator in line[end:]:
-            start = line.index(separator, end) + 1
-            line = line[start:]
+    >>> list(iter_fields('Hello,"wor,ld","a ""b"" c"'))
+    ['Hello', 'wor,ld', 'a "b" c']
+    """
+    position = 0
+    length = len(line)
+    step = len(separator)
+
+    while position < length:
+        if line[position] == quote:
+            parts = []
+            start = position + 1
+            while True:
+                end = line.find(quote, start)
+                if end == -1:
+                    parts.append(line[start:])
+                    position = length
+                    break
+
+                if line[end + 1:end + 2] == quote:
+                    parts.append(line[start:end + 1])
+                    start = end + 2
+                    continue
+
+                parts.append(line[start:end])
+                position = end + 1
+                break
+
+            term = ''.join(parts)
+
+            # Anything between the closing quote and the separator is dropped
+            end = line.find(separator, position)
+            position = length if end == -1 else end + step
         else:
-            line = ''
-    else:
-        if separator in line:
-            end = line.index(separator)
-            term = line[0:end]
+            end = line.find(separator, position)
+            if end == -1:
+                term = line[position:]
+                position = length
+            else:
+                term = line[position:end]
+                position = end + step
 
-            start = end + 1
-            line = line[start:]
-        else:
-            term = line
-            line = ''
+        yield term
 
-    return term, line
+
+def iter_rows(lines, separator=',', quote='"', use_csv=False):
+    """
+    Yields the values of every row in an iterable of lines
+    (a list, a file handle...).
+    Quoted values may span several lines. A quote inside a value
+    which is not quoted is taken as it is.
+
+    When use_csv is set, the C accelerated csv module does the parsing,
+    which needs a one character separator. It gives the same rows, but
+    for badly quoted values: text after the closing quote of a value
+    (which iter_fields drops and the csv module keeps), and a quote
+    left open at the end.
+
+    >>> list(iter_rows(['"a","b', 'c"', 'd,e']))
+    [['a', 'b\\nc'], ['d', 'e']]
+    >>> lines = ['1,ANA 5\\'10"', '2,BOB', '"3","a ""C"" b"']
+    >>> list(iter_rows(lines))
+    [['1', 'ANA 5\\'10"'], ['2', 'BOB'], ['3', 'a "C" b']]
+    >>> list(iter_rows(lines, use_csv=True)) == list(iter_rows(lines))
+    True
+    >>> list(iter_rows([u'"\\xf1","b', u'c",'], use_csv=True))
+    [[u'\\xf1', u'b\\nc']]
+    """
+    if use_csv:
+        for row in _iter_csv_rows(lines, separator, quote):
+            yield row
+        return
+
+    pending = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        # A quoted value left open goes on in the next line
+        if _ends_quoted(line, separator, quote, len(pending) > 0):
+            pending.append(line)
+            continue
+
+        if len(pending) > 0:
+            pending.append(line)
+            line = '\n'.join(pending)
+            pending = []
+
+        yield list(iter_fields(line, separator, quote))
+
+    if len(pending) > 0:
+        yield list(iter_fields('\n'.join(pending), separator, quote))
+
+
+def _iter_csv_rows(lines, separator, quote):
+    # The csv module of Python 2 only reads byte strings, so unicode
+    # lines go through it as UTF-8
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+
+    text = isinstance(first, unicode)
+    last = ['']
+
+    def encode(lines):
+        for line in lines:
+            if text:
+                line = line.encode('utf-8')
+            last[0] = line.rstrip('\r\n')
+            yield last[0] + '\n'
+
+    reader = csv.reader(encode(itertools.chain([first], lines)),
+                        delimiter=str(separator),
+                        quotechar=str(quote))
+    for row in reader:
+        # iter_fields finds no value after a separator ending the line
+        if len(row) > 1 and row[-1] == '' and\
+                last[0].endswith(str(separator)):
+            row.pop()
+
+        if text:
+            row = [value.decode('utf-8') for value in row]
+
+        yield row
+
+
+def _ends_quoted(line, separator, quote, quoted=False):
+    # Whether a line ends inside a quoted value, read as iter_fields does.
+    # quoted tells whether it starts inside one
+    position = 0
+    step = len(separator)
+    while True:
+        if quoted:
+            end = line.find(quote, position)
+            if end == -1:
+                return True
+
+            if line[end + 1:end + 2] == quote:
+                position = end + 2
+                continue
+
+            quoted = False
+            position = end + 1
+        elif line[position:position + 1] == quote:
+            quoted = True
+            position += 1
+            continue
+
+        end = line.find(separator, position)
+        if end == -1:
+            return False
+        position = end + step
 
 
 def split(line, separator=','):
@@ -137,27 +658,84 @@ def split(line, separator=','):
     >>> split(line)
     ['Hello', 'world']
     """
-    data = []
-    quote = '"'
-    while len(line) > 0:
-        term, line = _next_term(line, separator, quote)
-        data.append(unquote(term))
-
-    return data
+    return list(iter_fields(line, separator))
 
 
 def merge(data, separator=','):
     """
     Merges data into a CSV string and quotes it.
+    Quotes inside the values are doubled, as iter_fields reads them.
 
-    >>> data = ['Hello', 'wor,ld']
+    >>> data = ['Hello', 'wor,ld', 'a "b" c']
     >>> merge(data)
-    u'"Hello","wor,ld"'
+    u'"Hello","wor,ld","a ""b"" c"'
     """
-    s = separator.join(['"%s"' % unicode(x) for x in data])
+    s = separator.join(['"%s"' % unicode(x).replace(u'"', u'""')
+                        for x in data])
     return s
 
 
+class Matcher:
+    """
+    Matches texts against a fixed list of possibilities.
+    Normalizes the list once, so every lookup is a dictionary access.
+
+    Follows the same rules as match
+
+    >>> m = Matcher(['tortoise', 'PENGUINS', 'penguin'])
+    >>> m.match('Penguin'), m.match('tortoises'), m.match('cat')
+    (2, 0, -1)
+
+    >>> m.append('Cat')
+    >>> m.match('cats')
+    3
+    """
+    def __init__(self, possibilities=[]):
+        self.exact = {}
+        self.variants = {}
+        self.size = 0
+
+        for possibility in possibilities:
+            self.append(possibility)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, possibility):
+        """
+        Adds a possibility at the end of the list
+        """
+        index = self.size
+        self.size += 1
+
+        text = _normalize(possibility)
+        self.exact.setdefault(text, index)
+
+        # Text with an appended 's' matches this possibility
+        self.variants.setdefault(text + u's', index)
+
+        # Text without the trailing 's' matches this possibility
+        singular = text[:-1]
+        if text[-1:] == u's' and len(singular) > 0 and singular[-1] != u's':
+            self.variants.setdefault(singular, index)
+
+    def match(self, text):
+        """
+        Gets the index of the possibility matching the text
+        Returns -1 if no match is found
+        """
+        text = _normalize(text)
+        index = self.exact.get(text)
+        if index is None:
+            index = self.variants.get(text, -1)
+
+        return index
+
+
+def _normalize(text):
+    return unicode(text.strip().lower())
+
+
 def match(text, possibilities):
     """
     Match a text to one of the possible options
@@ -179,21 +757,10 @@ def match(text, possibilities):
     >>> match(text, possibilities)
     -1
     """
-    possibilities = [unicode(x.strip().lower()) for x in possibilities]
-    text = unicode(text.strip().lower())
-
-    if text in possibilities:
-        return possibilities.index(text)
-
-    if len(text) > 0 and text[-1] == u's':
-        if(text[:-1] in possibilities):
-            return possibilities.index(text[:-1])
-
-    if len(text) > 0 and text[-1] != u's':
-        if(text + u's' in possibilities):
-            return possibilities.index(text + u's')
+    if not isinstance(possibilities, Matcher):
+        possibilities = Matcher(possibilities)
 
-    return -1
+    return possibilities.match(text)
 
 
 def remove(paths):
@@ -1,35 +1,352 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
+import collections
 import easyio
+import itertools
+import metrics as metrics_module
+import multiprocessing
+import os
+import progress as progress_module
 import re
+import traceback
+
+
+# What _remove_empty_columns and _expand_rows need to know about all rows:
+# a flag for every column which has content, and the width of the widest row
+ColumnStats = collections.namedtuple('ColumnStats', ['occupied', 'width'])
+
+
+class RowStep:
+    """
+    A processing step working on parsed rows.
+    Calls the Editor method with the given name as
+    method(path, rows, *args), which returns the new rows
+    """
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+
+class ContentRemover:
+    """
+    Removes unwanted content from the cells of rows.
+    Built once, and used on every row of every file.
+
+    Cells matching one of contents (see easyio.Matcher) are emptied.
+    Then, every piece of a cell which is one of substrings (in any case)
+    or matches the regex pattern is taken out of it.
+
+    >>> remover = ContentRemover(['Y = RETIRADO'], substrings=['(R)'])
+    >>> row = ['y = retirado ', 'PEREZ (r)', '', '6.0']
+    >>> remover.remove(row), row
+    (True, ['', 'PEREZ', '', '6.0'])
+    >>> remover.remove(['6.0', 'PEREZ'])
+    False
+    """
+    def __init__(self, contents=[], substrings=[], pattern=None):
+        if isinstance(contents, easyio.Matcher):
+            self.matcher = contents
+        else:
+            self.matcher = easyio.Matcher(contents)
+
+        # Texts of other lengths can not match, once stripped
+        self.lengths = set([len(text) for text in self.matcher.exact] +
+                           [len(text) for text in self.matcher.variants])
+
+        patterns = [re.escape(substring) for substring in substrings]
+        if pattern is not None:
+            patterns.append(pattern)
+
+        self.regex = None
+        if len(patterns) > 0:
+            self.regex = re.compile(
+                '|'.join(['(?:%s)' % p for p in patterns]),
+                re.IGNORECASE | re.UNICODE)
+
+    def remove(self, row):
+        """
+        Removes the unwanted content from the cells of a row, in place.
+        Returns whether any cell changed
+        """
+        changed = False
+        for j, cell in enumerate(row):
+            if len(cell) == 0:
+                continue
+
+            if len(cell.strip()) in self.lengths and\
+                    self.matcher.match(cell) != -1:
+                row[j] = ''
+                changed = True
+            elif self.regex is not None:
+                text = self.regex.sub('', cell)
+                if text != cell:
+                    row[j] = text.strip()
+                    changed = True
+
+        return changed
 
 
 class Editor:
-    def __init__(self, separator=','):
+    # Steps which need ColumnStats about all rows when streaming
+    scan_steps = ('_remove_empty_columns', '_expand_rows')
+
+    def __init__(self, separator=',', metrics=None, progress=None,
+                 stream_threshold=None):
+        """
+        Initializes an instance of Editor
+        metrics (a metrics.Metrics) records the reading, every step and
+        the writing of each file
+        progress, if given, is called with a progress.Report
+        after every file
+        Files of stream_threshold bytes or more are processed as streams
+        of rows (see stream_file), which is slower but keeps memory low.
+        Set it for files which would not fit in memory. By default, every
+        file is processed in memory.
+        """
         self.separator = separator
-        self.empty = re.compile('^("")?(%s("")?)*$' % separator)
+        self.metrics = metrics or metrics_module.NULL
+        self.progress = progress
+        self.stream_threshold = stream_threshold
         self.processing_steps = []
         self.skip_files = []
+        self.skip_directories = []
+        self.errors = collections.OrderedDict()
+
+    def __getstate__(self):
+        """
+        Leaves progress out when pickled for the worker processes,
+        which do not report it (and reporters may hold streams)
+
+        >>> import pickle
+        >>> ed = Editor(progress=progress_module.ConsoleReporter())
+        >>> pickle.loads(pickle.dumps(ed)).progress is None
+        True
+        """
+        state = self.__dict__.copy()
+        state['progress'] = None
+        return state
 
-    def process(self, folder_path):
+    def process(self, folder_path, workers=None):
         """
         Does all the processing on all files on a given folder,
-        except for those explicitly skipped
-        """
-        # All files
-        files = easyio.get_files(folder_path, '.csv')
-        for path in files:
-            # No-skip files
-            if path not in self.skip_files:
-                # Each processing step takes as input path and content
-                # and returns the modified content
-                content = easyio.read_file(path)
-                for step in self.processing_steps:
-                    content = step(path, content)
-
-                # The content is written back to the file
-                # at the end of processing
-                easyio.write_file(path, content)
+        except for those explicitly skipped, or in skipped folders
+
+        With workers, files are processed in that many processes.
+        The processing steps must then be picklable, as RowSteps are.
+
+        Errors do not stop the other files. They are kept in errors
+        (path -> traceback), and raised together at the end.
+        """
+        # All files, but the skipped ones
+        files = easyio.get_files(folder_path,
+                                 ['.csv', easyio.ROWS_EXTENSION],
+                                 skip=self.skip_files,
+                                 skip_directories=self.skip_directories)
+
+        tracker = progress_module.Tracker(self.progress, len(files))
+        self.errors = collections.OrderedDict()
+
+        pool = None
+        if workers is not None and workers > 1:
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+            results = pool.imap(_process_file, files)
+        else:
+            results = (self.process_file(path) for path in files)
+
+        try:
+            for idx, (rows, error) in enumerate(results):
+                path = files[idx]
+                if error is not None:
+                    self.errors[path] = error
+                tracker.file_done(rows, os.path.getsize(path))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if len(self.errors) > 0:
+            raise RuntimeError('Processing failed on %d files:\n%s' % (
+                len(self.errors),
+                '\n'.join(['%s\n%s' % (path, error)
+                           for path, error in self.errors.items()])))
+
+    def process_file(self, path):
+        """
+        Does all the processing on a file, and writes it back.
+        Returns the number of rows read and None,
+        or 0 and the traceback if it fails
+        """
+        try:
+            if self.can_stream(path):
+                return self.stream_file(path), None
+
+            # The file is parsed once, every step works on its rows
+            with self.metrics.stage('edit.read', path=path) as stage:
+                rows = self.read(path)
+                count = len(rows)
+                stage.bytes_read = os.path.getsize(path)
+                stage.rows_out = count
+
+            rows = self.process_rows(path, rows)
+
+            # The content is written back to the file
+            # at the end of processing
+            with self.metrics.stage('edit.write', path=path) as stage:
+                self.write(path, rows)
+                stage.rows_in = len(rows)
+                stage.bytes_written = os.path.getsize(path)
+        except Exception:
+            return 0, traceback.format_exc()
+
+        return count, None
+
+    def can_stream(self, path):
+        """
+        Whether a file is processed by stream_file: it must be of
+        stream_threshold bytes or more, and every step a RowStep
+        """
+        if self.stream_threshold is None or\
+                os.path.getsize(path) < self.stream_threshold:
+            return False
+
+        return all([isinstance(step, RowStep) and
+                    hasattr(self, '_iter' + step.name)
+                    for step in self.processing_steps])
+
+    def stream_file(self, path):
+        """
+        Does all the processing on a file like process_file, without
+        keeping its rows in memory.
+
+        Every step in scan_steps first needs ColumnStats about all the rows
+        it gets. They are worked out in a pass over the file, through the
+        steps before it, keeping only the stats.
+        A last pass runs every step, writing the rows as they come.
+        Returns the number of rows read
+        """
+        stats = {}
+        for i, step in enumerate(self.processing_steps):
+            if step.name not in self.scan_steps:
+                continue
+
+            with self.metrics.stage('edit.scan', path=path,
+                                    step=step.name) as stage:
+                rows = metrics_module.Timed(
+                    easyio.read_rows(path, self.separator), self.metrics)
+                stats[i] = self.column_stats(
+                    self.iter_steps(path, rows, stats, i))
+                stage.rows_in = rows.count
+
+        with self.metrics.stage('edit.stream', path=path) as stage:
+            stage.bytes_read = os.path.getsize(path)
+            rows = metrics_module.Timed(
+                easyio.read_rows(path, self.separator), self.metrics)
+
+            with easyio.open_writer(path) as writer:
+                for row in self.iter_steps(path, rows, stats):
+                    writer.write_row(row, self.separator)
+
+            stage.rows_in = rows.count
+            stage.rows_out = writer.lines
+            stage.bytes_written = os.path.getsize(path)
+
+        return rows.count
+
+    def iter_steps(self, path, rows, stats, count=None):
+        """
+        Chains the streaming forms (_iter methods) of the first count
+        processing steps over rows.
+        stats has the ColumnStats for the steps in scan_steps, by position
+        """
+        for i, step in enumerate(self.processing_steps[:count]):
+            method = getattr(self, '_iter' + step.name)
+            if step.name in self.scan_steps:
+                rows = method(path, rows, stats[i])
+            else:
+                rows = method(path, rows, *step.args)
+
+        return rows
+
+    def column_stats(self, rows):
+        """
+        Gets the ColumnStats of rows in a single pass, without keeping them
+
+        >>> e = Editor()
+        >>> e.column_stats([['a', ''], ['', ' ', 'c']])
+        ColumnStats(occupied=bytearray(b'\\x01\\x00\\x01'), width=3)
+        """
+        occupied = bytearray()
+        width = 0
+        for row in rows:
+            if len(row) > width:
+                occupied.extend(bytearray(len(row) - width))
+                width = len(row)
+
+            for i, x in enumerate(row):
+                if not occupied[i] and len(x.strip()) > 0:
+                    occupied[i] = 1
+
+        return ColumnStats(occupied, width)
+
+    def process_rows(self, path, rows):
+        """
+        Runs all processing steps on the rows of a file.
+
+        Steps which are not RowSteps are taken to be functions of
+        (path, content) returning the modified content, and get
+        the rows serialized back to CSV.
+        """
+        for step in self.processing_steps:
+            name = getattr(step, 'name', None) or\
+                getattr(step, '__name__', repr(step))
+            stage = self.metrics.stage('edit.step', path=path, step=name)
+            with stage:
+                stage.rows_in = len(rows)
+                if isinstance(step, RowStep):
+                    rows = getattr(self, step.name)(path, rows, *step.args)
+                else:
+                    rows = self.parse(step(path, self.serialize(rows)))
+                stage.rows_out = len(rows)
+
+        return rows
+
+    def read(self, path):
+        """
+        Reads the rows of a csv file, or of a file written by
+        easyio.RowsWriter (with easyio.ROWS_EXTENSION)
+        """
+        if easyio.get_extension(path) == easyio.ROWS_EXTENSION:
+            return list(easyio.iter_binary_rows(path))
+
+        lines = easyio.iter_mapped_lines(path)
+        return list(easyio.iter_rows(lines, self.separator))
+
+    def write(self, path, rows):
+        """
+        Writes rows to a file, in the format read gets from its path
+        """
+        if easyio.get_extension(path) == easyio.ROWS_EXTENSION:
+            with easyio.RowsWriter(path) as writer:
+                for row in rows:
+                    writer.write_row(row)
+        else:
+            easyio.write_file(path, self.serialize(rows))
+
+    def parse(self, content):
+        """
+        Splits CSV content into rows of values
+
+        >>> e = Editor()
+        >>> e.parse('a,"b"\\n\\n1,2')
+        [['a', 'b'], [], ['1', '2']]
+        """
+        return list(easyio.iter_rows(content.split('\n'), self.separator))
+
+    def serialize(self, rows):
+        """
+        Merges rows of values back into CSV content
+        """
+        return '\n'.join([easyio.merge(row, self.separator) for row in rows])
 
     def skip_files_in_processing(self, files):
         """
@@ -40,30 +357,35 @@ class Editor:
 
         self.skip_files.extend(files)
 
+    def skip_directories_in_processing(self, directories):
+        """
+        Sets folders not to look into during processing
+        """
+        if not isinstance(directories, list):
+            directories = [directories]
+
+        self.skip_directories.extend(directories)
+
     def add_columns_in_processing(self, header, regex_pattern):
         """
         Adds a column at the end of every file.
         The header is given by argument, and the value is extracted
         from the file name using the given regex pattern.
         """
-        regex = re.compile(regex_pattern)
-        value = lambda path: regex.search(easyio.path_leaf(path)).group()
-
         self.processing_steps.append(
-            lambda path, content:
-                self._add_column(path, content, header, value(path)))
+            RowStep('_add_column', header, regex_pattern))
 
     def remove_empty_columns_in_processing(self):
         """
         Remove all empty collumns
         """
-        self.processing_steps.append(self._remove_empty_columns)
+        self.processing_steps.append(RowStep('_remove_empty_columns'))
 
     def trim_in_processing(self):
         """
         Remove empty rows
         """
-        self.processing_steps.append(self._trim)
+        self.processing_steps.append(RowStep('_trim'))
 
     def set_headers_in_processing(self, headers_dict):
         """
@@ -71,113 +393,144 @@ class Editor:
         Receives a dictionary (int, str) with indices and headers
         """
         self.processing_steps.append(
-            lambda path, content:
-                self._set_headers(path, content, headers_dict))
+            RowStep('_set_headers', headers_dict))
 
     def collapse_headers_in_processing(self,
                                        fixed_columns,
                                        optional_columns,
-                                       ignore_columns):
+                                       ignore_columns,
+                                       max_header_depth=20):
         """
         Collapse headers into one row.
-        Will keep collapsing headers until all fixed_columns are found.
+        Will keep collapsing headers until all fixed_columns are found,
+        looking at most at the first max_header_depth rows.
         Every column has its cells merged until either it matches a
         fixed/optional column or every fixed_column is found.
 
         If a header matches an ignore_column it is also no longer processed.
         """
+        column_matcher = easyio.Matcher(fixed_columns + optional_columns)
+        ignore_matcher = easyio.Matcher(ignore_columns)
+
         self.processing_steps.append(
-            lambda path, content:
-                self._collapse_headers(path,
-                                       content,
-                                       fixed_columns,
-                                       optional_columns,
-                                       ignore_columns))
+            RowStep('_collapse_headers',
+                    fixed_columns,
+                    optional_columns,
+                    ignore_columns,
+                    column_matcher,
+                    ignore_matcher,
+                    max_header_depth))
 
     def expand_rows_in_processing(self):
         """
         Expand rows with empty spaces until they all are the same length
         """
-        self.processing_steps.append(self._expand_rows)
+        self.processing_steps.append(RowStep('_expand_rows'))
 
-    def remove_content_in_processing(self, unwanted_content):
+    def remove_content_in_processing(self, unwanted_content,
+                                     substrings=[], pattern=None):
         """
-        Remove specific content from cells
+        Remove specific content from cells.
+        Cells matching unwanted_content are emptied, and the substrings
+        and the matches of the regex pattern are taken out of the others
+        (see ContentRemover)
         """
-        self.processing_steps.append(
-            lambda path, content:
-                self._remove_content(path, content, unwanted_content))
+        remover = ContentRemover(unwanted_content, substrings, pattern)
+
+        self.processing_steps.append(RowStep('_remove_content', remover))
+
+    def _is_empty(self, row):
+        """
+        Whether a row has no values
+        """
+        for x in row:
+            if len(x) > 0:
+                return False
 
-    def _add_column(self, path, content, header, value):
+        return True
+
+    def _add_column(self, path, rows, header, regex_pattern):
         """
         Internal function to add column
         """
-        lines = content.split('\n')
-        if len(lines) > 0:
-            lines[0] = self.separator.join([lines[0],
-                                           easyio.quote(header,
-                                                        self.separator)])
+        return list(self._iter_add_column(path, rows, header, regex_pattern))
+
+    def _iter_add_column(self, path, rows, header, regex_pattern):
+        value = re.search(regex_pattern, easyio.path_leaf(path)).group()
 
-        for i in range(1, len(lines)):
-            if not self.empty.match(lines[i]):
-                lines[i] = self.separator.join([lines[i],
-                                               easyio.quote(value,
-                                                            self.separator)])
+        for i, row in enumerate(rows):
+            if i == 0:
+                row.append(header)
+            elif not self._is_empty(row):
+                row.append(value)
 
-        content = '\n'.join(lines)
-        return content
+            yield row
 
-    def _trim(self, path, content):
+    def _trim(self, path, rows):
         """
         Internal function to trim
         """
-        lines = content.split('\n')
+        return list(self._iter_trim(path, rows))
 
-        new_lines = []
-        for line in lines:
-            if not self.empty.match(line):
-                new_lines.append(line)
+    def _iter_trim(self, path, rows):
+        return (row for row in rows if not self._is_empty(row))
 
-        lines = new_lines
-        content = '\n'.join(lines)
-        return content
-
-    def _set_headers(self, path, content, headers_dict):
+    def _set_headers(self, path, rows, headers_dict):
         """
         Internal function to set headers
         """
-        lines = content.split('\n')
-        current_headers = easyio.split(lines[0], self.separator)
+        if len(rows) == 0:
+            return rows
+
+        current_headers = rows[0]
         for key in headers_dict:
             if key < len(current_headers):
                 current_headers[key] = headers_dict[key]
 
-        lines[0] = easyio.merge(current_headers, self.separator)
-        content = '\n'.join(lines)
-        return content
+        return rows
 
-    def _collapse_headers(self, path, content,
-                          fixed_columns, optional_columns, ignore_columns):
+    def _iter_set_headers(self, path, rows, headers_dict):
+        for i, row in enumerate(rows):
+            if i == 0:
+                self._set_headers(path, [row], headers_dict)
+
+            yield row
+
+    def _collapse_headers(self, path, rows,
+                          fixed_columns, optional_columns, ignore_columns,
+                          columns=None, ignore=None, max_depth=None):
         """
         Internal function to collapse headers
-        """
-        lines = content.split('\n')
+        Takes optional Matchers already built for the columns
+        (fixed and optional) and the ignore_columns, and the most
+        header rows to collapse.
+        The rows after the headers are kept as they are.
 
-        current_headers = ['' for header in
-                           easyio.split(lines[0], self.separator)]
+        >>> rows = [['', 'A'], ['ID', 'B'], ['1', '2'], ['3', '4']]
+        >>> e = Editor()
+        >>> e._collapse_headers('', rows, ['ID'], [], [])
+        [['ID', 'A B'], ['1', '2'], ['3', '4']]
+        """
+        current_headers = ['' for header in (rows[0] if rows else [])]
 
-        columns = fixed_columns[:] + optional_columns[:]
+        if columns is None:
+            columns = easyio.Matcher(fixed_columns + optional_columns)
+        if ignore is None:
+            ignore = easyio.Matcher(ignore_columns)
 
         column_lock = [False] * len(current_headers)
         header_ok = [False] * len(fixed_columns) +\
             [True] * len(optional_columns)
 
-        while not all(header_ok):
-            if len(lines) == 0:
-                break
+        depth = len(rows)
+        if max_depth is not None:
+            depth = min(depth, max_depth)
 
-            new_headers = easyio.split(lines[0], self.separator)
-            lines = lines[1:]
+        # Only a cursor moves over the header rows, without copying the rest
+        consumed = 0
+        while not all(header_ok) and consumed < depth:
+            new_headers = rows[consumed]
+            consumed += 1
 
             for i, header in enumerate(new_headers):
                 if column_lock[i]:
@@ -187,87 +540,121 @@ class Editor:
                 # if i > 0 and new_headers[i] == '':
                 #     new_headers[i] = new_headers[i - 1]
 
-                match = easyio.match(header, columns)
+                match = columns.match(header)
                 if match != -1:
                     current_headers[i] = header
                     header_ok[match] = True
                     column_lock[i] = True
-                elif easyio.match(current_headers[i], ignore_columns) != -1:
+                elif ignore.match(current_headers[i]) != -1:
                         column_lock[i] = True
                 else:
                     current_headers[i] =\
                         (current_headers[i] + ' ' + header).strip()
 
-                    match = easyio.match(current_headers[i], columns)
+                    match = columns.match(current_headers[i])
                     if match != -1:
                         header_ok[match] = True
                         column_lock[i] = True
-                    if easyio.match(current_headers[i], ignore_columns) != -1:
+                    if ignore.match(current_headers[i]) != -1:
                         column_lock[i] = True
 
-        lines.insert(0, easyio.merge(current_headers, self.separator))
-        content = '\n'.join(lines)
-        return content
+        rows[:consumed] = [current_headers]
+        return rows
+
+    def _iter_collapse_headers(self, path, rows,
+                               fixed_columns, optional_columns,
+                               ignore_columns,
+                               columns=None, ignore=None, max_depth=None):
+        # Only the first max_depth rows can be headers
+        rows = iter(rows)
+        if max_depth is None:
+            head = list(rows)
+        else:
+            head = list(itertools.islice(rows, max_depth))
+
+        head = self._collapse_headers(path, head,
+                                      fixed_columns, optional_columns,
+                                      ignore_columns,
+                                      columns, ignore, max_depth)
+
+        return itertools.chain(head, rows)
 
-    def _expand_rows(self, path, content):
+    def _expand_rows(self, path, rows):
         """
         Internal function to expand rows
         """
-        lines = content.split('\n')
-        data = []
         max_columns = 0
-        for line in lines:
-            columns = easyio.split(line, self.separator)
-            max_columns = max(len(columns), max_columns)
-            data.append(columns)
+        for row in rows:
+            max_columns = max(len(row), max_columns)
 
-        for i in range(len(lines)):
-            extra = max_columns - len(data[i])
-            data[i].extend([''] * extra)
-            lines[i] = easyio.merge(data[i], self.separator)
+        return list(self._iter_expand_rows(path, rows,
+                                           ColumnStats(None, max_columns)))
 
-        content = '\n'.join(lines)
-        return content
+    def _iter_expand_rows(self, path, rows, stats):
+        for row in rows:
+            if len(row) < stats.width:
+                row.extend([''] * (stats.width - len(row)))
 
-    def _remove_content(self, path, content, unwanted_content):
+            yield row
+
+    def _remove_content(self, path, rows, unwanted_content):
         """
         Internal function to remove content
+        unwanted_content may be a list, an easyio.Matcher
+        or a ContentRemover
         """
-        lines = content.split('\n')
-        for i in range(len(lines)):
-            data = easyio.split(lines[i], self.separator)
-            for j in range(len(data)):
-                if easyio.match(data[j], unwanted_content) != -1:
-                    data[j] = ''
-            lines[i] = easyio.merge(data, self.separator)
+        return list(self._iter_remove_content(path, rows, unwanted_content))
+
+    def _iter_remove_content(self, path, rows, unwanted_content):
+        remover = unwanted_content
+        if not isinstance(remover, ContentRemover):
+            remover = ContentRemover(unwanted_content)
 
-        content = '\n'.join(lines)
-        return content
+        # Rows are changed in place, those without unwanted content
+        # are left as they are
+        for row in rows:
+            remover.remove(row)
+            yield row
 
-    def _remove_empty_columns(self, path, content):
+    def _remove_empty_columns(self, path, rows):
         """
         Internal function to remove empty columns
 
-        >>> content='a,b,,,e\\n1,2,,,5'
+        >>> rows = [['a', 'b', '', '', 'e'], ['1', '2', '', ' ', '5']]
         >>> e = Editor()
-        >>> e._remove_empty_columns('', content)
-        '"a","b","e"\\n"1","2","5"'
-        """
-        lines = content.split('\n')
-        all_data = [easyio.split(line, self.separator) for line in lines]
-        has_content = set()
-        for data in all_data:
-            for i, x in enumerate(data):
-                if len(x.strip()) > 0:
-                    has_content.add(i)
-
-        new_lines = []
-        for data in all_data:
-            new_data = [x for i, x in enumerate(data) if i in has_content]
-            new_lines.append(easyio.merge(new_data, self.separator))
-
-        content = '\n'.join(new_lines)
-        return content
+        >>> e._remove_empty_columns('', rows)
+        [['a', 'b', 'e'], ['1', '2', '5']]
+        """
+        return list(self._iter_remove_empty_columns(path, rows,
+                                                    self.column_stats(rows)))
+
+    def _iter_remove_empty_columns(self, path, rows, stats):
+        keep = [i for i, flag in enumerate(stats.occupied) if flag]
+
+        # Rows are only copied when there is some column to remove
+        if len(keep) == stats.width:
+            for row in rows:
+                yield row
+            return
+
+        for row in rows:
+            if len(row) == stats.width:
+                yield [row[i] for i in keep]
+            else:
+                yield [row[i] for i in keep if i < len(row)]
+
+
+# Editor used by the processes of Editor.process
+_editor = None
+
+
+def _init_worker(editor):
+    global _editor
+    _editor = editor
+
+
+def _process_file(path):
+    return _editor.process_file(path)
 
 
 def test():
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import cPickle
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+
+def file_entry(path, previous=None, stat=None):
+    """
+    Gets the manifest entry of a file: its path (as path_key gives it),
+    size, modification time and content hash.
+    The hash of the previous entry is kept if size and time did not change.
+    The os.stat of the file is taken, unless it is given.
+    """
+    if stat is None:
+        stat = os.stat(path)
+    entry = {'path': path_key(path),
+             'size': stat.st_size,
+             'mtime': stat.st_mtime}
+
+    if previous is not None and\
+            previous['size'] == entry['size'] and\
+            previous['mtime'] == entry['mtime']:
+        entry['hash'] = previous['hash']
+    else:
+        entry['hash'] = file_hash(path)
+
+    return entry
+
+
+def path_key(path):
+    """
+    Gets a path as unicode, the way it reads back from a manifest,
+    decoding it with the file system encoding (or latin-1 if it is not
+    valid in it)
+
+    >>> path_key('a.csv')
+    u'a.csv'
+    """
+    if isinstance(path, unicode):
+        return path
+
+    try:
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return path.decode('latin-1')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Gets the SHA-1 hex digest of the content of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_manifest(path):
+    """
+    Retrieves a manifest, or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    """
+    Writes a manifest as JSON
+    """
+    _replace(path, 'w', lambda f: json.dump(manifest, f, indent=1))
+
+
+def read_state(path):
+    """
+    Retrieves a pickled merge state, or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return cPickle.load(f)
+
+
+def write_state(path, state):
+    """
+    Pickles a merge state
+    """
+    _replace(path, 'wb',
+             lambda f: cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL))
+
+
+def _replace(path, mode, write):
+    # Writes a file under a temporary name next to path, and only then
+    # renames it to path, as easyio.Writer does
+    directory, name = os.path.split(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(
+        prefix=name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, mode) as f:
+            write(f)
+
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary_path, 0o666 & ~umask)
+
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary_path, path)
+    except Exception:
+        os.remove(temporary_path)
+        raise
@@ -1,7 +1,17 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
+import collections
 import easyio
+import manifest
+import metrics as metrics_module
+import multiprocessing
+import os
+import progress as progress_module
 import re
+import stores
+
+# Default progress, printed with a progress.ConsoleReporter
+CONSOLE = object()
 
 
 class Merger:
@@ -11,9 +21,40 @@ class Merger:
                  ignore_columns=[],
                  merge_columns=[],
                  expect_new_columns=False,
-                 new_columns_regex=''):
+                 new_columns_regex='',
+                 memory_budget=None,
+                 spill_directory=None,
+                 sqlite_path=None,
+                 incremental=False,
+                 sparse=False,
+                 packed=False,
+                 metrics=None,
+                 progress=CONSOLE):
         """
         Initializes an instance of Merger
+
+        With a memory_budget (in bytes), merged rows over the budget are
+        spilled to sorted run files in spill_directory (by default the
+        temporary directory), and the output is sorted by identifier.
+
+        With a sqlite_path, merged rows are kept in a SQLite database
+        there instead, which is left in place after the merge.
+
+        With sparse, merged rows only keep their non empty values in memory,
+        which suits wide merges where every row has few of the columns.
+
+        With packed, merged rows are kept in memory as marshal strings,
+        which takes less memory but more time per update.
+
+        metrics (a metrics.Metrics) records parsing, index building,
+        merging, serializing and writing
+
+        progress is called with a progress.Report after every file.
+        By default it is printed with a progress.ConsoleReporter,
+        and with None it is not reported
+
+        With incremental, merge_folder only reads the files which changed
+        since the last merge to the same output (see merge_files_incremental)
         """
         self.separator = separator
         self.fixed_columns = fixed_columns
@@ -21,31 +62,74 @@ class Merger:
         self.merge_columns = merge_columns
         self.expect_new_columns = expect_new_columns
         self.new_columns_regex = re.compile(new_columns_regex)
+        self.ignore_matcher = easyio.Matcher(ignore_columns)
+        self.memory_budget = memory_budget
+        self.spill_directory = spill_directory
+        self.sqlite_path = sqlite_path
+        self.incremental = incremental
+        self.sparse = sparse
+        self.packed = packed
+        self.metrics = metrics or metrics_module.NULL
+        self.progress = progress
+        if progress is CONSOLE:
+            self.progress = progress_module.ConsoleReporter()
+
+    def __getstate__(self):
+        """
+        Leaves progress out when pickled for the worker processes,
+        as Editor does
+
+        >>> import pickle
+        >>> merger = Merger(fixed_columns=[u'ID'], new_columns_regex='a')
+        >>> merger = pickle.loads(pickle.dumps(merger))
+        >>> merger.progress is None, merger.new_columns_regex.pattern
+        (True, 'a')
+        """
+        state = self.__dict__.copy()
+        state['progress'] = None
+        return state
 
-    def merge_folder(self, folder_path, output_path):
+    def merge_folder(self, folder_path, output_path, workers=None,
+                     skip_directories=()):
         """
         Merges them according to fixed_columns
+        The output is not read as input, nor are the files in
+        skip_directories.
         """
         # Create CSVs for each sheet in the directory
-        files = easyio.get_files(folder_path, '.csv')
-        if output_path in files:
-            files.remove(output_path)
-
-        self.merge_files(files, output_path)
+        stats = {}
+        files = easyio.get_files(folder_path,
+                                 ['.csv', easyio.ROWS_EXTENSION],
+                                 skip=[output_path],
+                                 stats=stats if self.incremental else None,
+                                 skip_directories=skip_directories)
+
+        if self.incremental:
+            self.merge_files_incremental(files, output_path, stats)
+        else:
+            self.merge_files(files, output_path, workers)
 
     def get_headers_and_data(self, file):
         """
         Gets the column names and the remaining data
         """
-        content = easyio.read_file(file)
-        lines = content.split('\n')
+        rows = easyio.read_rows(file, self.separator)
 
-        headers = easyio.split(lines[0], self.separator)
-        lines = [easyio.split(line, self.separator)
-                 for line in lines[1:] if line != '']
+        headers = next(rows, [])
+        lines = [row for row in rows if len(row) > 0]
 
         return headers, lines
 
+    def iter_headers_and_data(self, file):
+        """
+        Gets the column names and a generator of the remaining data,
+        which reads the file one row at a time
+        """
+        rows = easyio.read_rows(file, self.separator)
+        headers = next(rows, [])
+
+        return headers, (row for row in rows if len(row) > 0)
+
     def build_indices(self, headers, lookups):
         """
         Gets a dictionary (column: match_id)
@@ -58,16 +142,20 @@ class Merger:
         >>> m.build_indices(headers, lookups) == expected_result
         True
         """
-        matches = {i: easyio.match(header, lookups)
+        if not isinstance(lookups, easyio.Matcher):
+            lookups = easyio.Matcher(lookups)
+
+        matches = {i: lookups.match(header)
                    for i, header in enumerate(headers)}
         return matches
 
-    def build_column_indices(self, headers, columns, prepend):
+    def build_column_indices(self, headers, columns, prepend, matcher=None):
         """
         Gets a dictionary for all columns
         (Output Column Index -> File Column Index)
 
         Adds new columns to the definition if need be
+        The matcher, if given, must hold the same columns and is kept in sync
 
         >>> fc = ['A', 'B']
         >>> columns = ['A', 'B']
@@ -86,15 +174,18 @@ class Merger:
         >>> columns
         ['A', 'B', '1 C']
         """
-        indices = self.build_indices(headers, columns)
+        if matcher is None:
+            matcher = easyio.Matcher(columns)
+
+        indices = self.build_indices(headers, matcher)
 
         for i, header in enumerate(headers):
             if indices[i] == -1:
-                if easyio.match(header, self.ignore_columns) != -1:
+                if self.ignore_matcher.match(header) != -1:
                     continue
 
                 column_name = (' '.join([prepend, headers[i]])).strip()
-                match = easyio.match(column_name, columns)
+                match = matcher.match(column_name)
                 if match != -1:
                     indices[i] = match
                 else:
@@ -103,6 +194,7 @@ class Merger:
                               'NO SE ESPERAN NUEVAS COLUMNAS:')
                     indices[i] = len(columns)
                     columns.append(column_name)
+                    matcher.append(column_name)
 
         return indices
 
@@ -124,61 +216,471 @@ class Merger:
 
         return data
 
-    def merge_files(self, files, output):
+    def create_store(self, columns):
+        """
+        Gets an empty store for the merged rows
+        """
+        if self.sqlite_path is not None:
+            return stores.SqliteStore(self.sqlite_path, columns)
+
+        if self.memory_budget is not None:
+            return stores.SpillStore(self.memory_budget,
+                                     self.spill_directory)
+
+        if self.sparse:
+            return stores.SparseStore()
+
+        if self.packed:
+            return stores.PackedStore()
+
+        return stores.DictStore()
+
+    def merge_files(self, files, output, workers=None):
         """
         Processess all csv files given
         Matches them according to the fixed_columns
         Leaves output csv at output argument
+
+        With workers, the files are read and merged in that many processes
+        (see merge_files_parallel)
+        """
+        if workers is not None and workers > 1:
+            self.merge_files_parallel(files, output, workers)
+            return
+
+        sources = ((path,) + self.iter_headers_and_data(path)
+                   for path in files)
+        self.merge_sources(sources, output, len(files))
+
+    def merge_files_parallel(self, files, output, workers):
+        """
+        Merges like merge_files, with the files read and merged in
+        a pool of processes, and their results combined in order.
+
+        The header rows are read first, and the columns are matched
+        in order, so every process gets the final indices of its file.
+        Each one then returns the rows of its file merged by identifier
+        in order of appearance. The output is the same as merge_files.
         """
         columns = self.fixed_columns[:] + self.merge_columns[:]
-        data = {}
+        matcher = easyio.Matcher(columns)
+
+        tasks = []
+        for path in files:
+            with self.metrics.stage('merge.index', path=path):
+                headers, rows = self.iter_headers_and_data(path)
+                rows.close()
+                indices = self.build_file_indices(path, headers, columns,
+                                                  matcher)
+                tasks.append((path, indices, len(columns)))
+
+        data = self.create_store(columns)
+        tracker = progress_module.Tracker(self.progress, len(files))
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            partials = pool.imap(_merge_file, tasks)
+            for idx, (partial, count) in enumerate(partials):
+                with self.metrics.stage('merge.reduce',
+                                        path=files[idx]) as stage:
+                    for identifier, (width, values) in partial.items():
+                        data.update_values(identifier, width, values.items())
+                    stage.rows_in = len(partial)
+
+                tracker.file_done(count, os.path.getsize(files[idx]))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.write_output(columns, data, output)
+        data.close()
+
+    def merge_file(self, path, indices, width):
+        """
+        Merges the rows of a file by identifier, given the indices of its
+        columns, and the number of columns there were after its headers.
+        Returns an OrderedDict (identifier -> [width, {column: value}]),
+        as kept by stores.SparseStore, and the number of rows read.
+        """
+        headers, rows = self.iter_headers_and_data(path)
+        data = stores.SparseStore(collections.OrderedDict())
+
+        with self.metrics.stage('merge.merge', path=path) as stage:
+            rows = metrics_module.Timed(rows, self.metrics)
+            self.merge_data(rows, indices, [None] * width, data)
+            stage.rows_in = rows.count
+            stage.rows_out = len(data)
+            stage.duplicates = rows.count - len(data)
+            stage.bytes_read = os.path.getsize(path)
+
+        return data.data, rows.count
+
+    def merge_files_incremental(self, files, output, stats={}):
+        """
+        Merges like merge_files, with the same output, reading only the
+        files which were added or changed since the last merge to the
+        same output.
+
+        Next to the output, a manifest records the size, modification time
+        and hash of every file, and a state file keeps the headers of
+        every file and what its rows contributed to every identifier.
+        The merge is then replayed from those, in the order of files.
+        When the only changes are new files after all the others, the saved
+        columns and records are kept, and only the new files are replayed.
+
+        stats may have the os.stat of the files by path, taken when
+        finding them.
+
+        >>> import tempfile
+        >>> folder = tempfile.mkdtemp()
+        >>> def write(name, content):
+        ...     easyio.write_file(os.path.join(folder, name), content)
+        >>> def merge(names):
+        ...     files = [os.path.join(folder, name) for name in names]
+        ...     outputs = [os.path.join(folder, name)
+        ...                for name in ['inc.out', 'full.out']]
+        ...     settings = {'fixed_columns': [u'ID'],
+        ...                 'expect_new_columns': True,
+        ...                 'new_columns_regex': '[a-z](?=.csv)',
+        ...                 'progress': None}
+        ...     Merger(**settings).merge_files_incremental(files, outputs[0])
+        ...     Merger(**settings).merge_files(files, outputs[1])
+        ...     return [easyio.read_file(path) for path in outputs]
+        >>> write('a.csv', u'ID,X\\n1,a\\n2,b')
+        >>> write('b.csv', u'ID,Y\\n1,c\\n3,d')
+        >>> inc, full = merge(['a.csv', 'b.csv'])
+        >>> inc == full
+        True
+
+        New files at the end, or anywhere else
+        >>> write('c.csv', u'ID,Z\\n3,e\\n4,f')
+        >>> write('d.csv', u'ID,X,Y\\n2,g,h')
+        >>> inc, full = merge(['a.csv', 'b.csv', 'c.csv'])
+        >>> inc == full
+        True
+        >>> inc, full = merge(['d.csv', 'a.csv', 'b.csv', 'c.csv'])
+        >>> inc == full, inc.split('\\n')[0]
+        (True, u'"ID","d X","d Y","a X","b Y","c Z"')
+
+        Changed and removed files
+        >>> write('a.csv', u'ID,X\\n1,changed\\n5,i')
+        >>> inc, full = merge(['d.csv', 'a.csv', 'b.csv', 'c.csv'])
+        >>> inc == full
+        True
+        >>> inc, full = merge(['a.csv', 'c.csv'])
+        >>> inc == full, inc.split('\\n')[0]
+        (True, u'"ID","a X","c Z"')
+
+        Unchanged files are not read again, whatever their name
+        >>> write('DISE\\xc3\\x91O.csv', u'ID,W\\n1,j')
+        >>> merger = Merger(fixed_columns=[u'ID'], expect_new_columns=True,
+        ...                 progress=None)
+        >>> output = os.path.join(folder, 'names.out')
+        >>> files = [os.path.join(folder, 'DISE\\xc3\\x91O.csv')]
+        >>> merger.merge_files_incremental(files, output)
+        >>> read = []
+        >>> merger.read_contribution = read.append
+        >>> merger.merge_files_incremental(files, output)
+        >>> read
+        []
+        """
+        manifest_path = output + '.manifest'
+        state_path = output + '.state'
+        settings = self.settings()
+
+        previous = manifest.read_manifest(manifest_path)
+        state = None
+        if previous is not None and previous['settings'] == settings:
+            state = manifest.read_state(state_path)
+
+        if state is None:
+            previous = {'files': []}
+            state = {'columns': None, 'data': None, 'contributions': {}}
+
+        contributions = state['contributions']
+
+        # Files are known by their unicode path, as the manifest has them
+        keys = collections.OrderedDict(
+            (manifest.path_key(path), path) for path in files)
+        old_entries = dict((entry['path'], entry)
+                           for entry in previous['files'])
+        entries = [manifest.file_entry(path, old_entries.get(key),
+                                       stats.get(path))
+                   for key, path in keys.items()]
+
+        unchanged = [entry['path'] for entry in entries
+                     if entry['path'] in old_entries and
+                     entry['hash'] == old_entries[entry['path']]['hash']]
+        unchanged_set = set(unchanged)
+        changed = [key for key in keys if key not in unchanged_set]
+
+        # New files after all the unchanged ones, in the same order,
+        # can go on top of the saved records
+        on_top = state['data'] is not None and\
+            list(keys)[:len(unchanged)] == unchanged and\
+            [entry['path'] for entry in previous['files']] == unchanged
+
+        # Nothing changed, so the output of the last run stands
+        if on_top and len(changed) == 0 and os.path.exists(output):
+            manifest.write_manifest(manifest_path,
+                                    {'settings': settings, 'files': entries})
+            return
+
+        for key in list(contributions):
+            if key not in unchanged_set:
+                del contributions[key]
+
+        tracker = progress_module.Tracker(self.progress, len(changed))
+        for key in changed:
+            contributions[key] = self.read_contribution(keys[key])
+            tracker.file_done(contributions[key][2],
+                              os.path.getsize(keys[key]))
+
+        if on_top:
+            columns = state['columns']
+            data = stores.DictStore(state['data'])
+            replayed = changed
+        else:
+            columns = self.fixed_columns[:] + self.merge_columns[:]
+            data = stores.DictStore()
+            replayed = list(keys)
+
+        matcher = easyio.Matcher(columns)
+        for key in replayed:
+            headers, contribution, count = contributions[key]
+            indices = self.build_file_indices(keys[key], headers, columns,
+                                              matcher)
+            width = len(columns)
+            for identifier, values in contribution.items():
+                data.update_values(identifier, width,
+                                   [(indices[i], x) for i, x in values])
+
+        self.write_output(columns, data, output)
+
+        state['columns'] = columns
+        state['data'] = data.data
+        manifest.write_state(state_path, state)
+        manifest.write_manifest(manifest_path,
+                                {'settings': settings, 'files': entries})
+
+    def read_contribution(self, path):
+        """
+        Reads what a file contributes to the merge, independently of the
+        columns of the files before it: its headers, an OrderedDict
+        (identifier -> [(file column index, value)]) of the non empty
+        values of its rows in order, and the number of rows read.
+
+        merge_data gives the same records from the values, once the
+        file column indices are mapped to output columns.
+        """
+        headers, rows = self.iter_headers_and_data(path)
+
+        # Which file columns are kept, and which are fixed, does not
+        # depend on the columns of the files before it
+        matcher = easyio.Matcher(self.fixed_columns + self.merge_columns)
+        regex_match = self.new_columns_regex.search(path)
+        prepend = regex_match.group() if regex_match else u''
+        fixed_width = len(self.fixed_columns)
+
+        cells = []
+        for i, header in enumerate(headers):
+            column = matcher.match(header)
+            if column == -1:
+                if self.ignore_matcher.match(header) != -1:
+                    continue
+                column = matcher.match((' '.join([prepend, header])).strip())
+
+            # Any column which is not fixed will do
+            cells.append((i, column if column != -1 else fixed_width))
+
+        contribution = collections.OrderedDict()
+        count = 0
+        for row in rows:
+            count += 1
+            length = len(row)
+            values = [(i, column, row[i]) for i, column in cells
+                      if i < length and len(row[i]) > 0]
+
+            identifier_data = [u''] * fixed_width
+            for i, column, value in values:
+                if column < fixed_width:
+                    identifier_data[column] = value
+
+            contribution.setdefault(tuple(identifier_data), []).extend(
+                [(i, value) for i, column, value in values])
+
+        # Only the last value of every file column counts
+        for identifier, values in contribution.items():
+            seen = set()
+            last = []
+            for i, value in reversed(values):
+                if i not in seen:
+                    seen.add(i)
+                    last.append((i, value))
+            last.reverse()
+            contribution[identifier] = last
+
+        return headers, contribution, count
+
+    def settings(self):
+        """
+        Gets the settings which change how the files are merged
+        """
+        return [self.separator,
+                self.fixed_columns,
+                self.ignore_columns,
+                self.merge_columns,
+                self.expect_new_columns,
+                self.new_columns_regex.pattern]
+
+    def merge_rows(self, sheets, output):
+        """
+        Merges sheets given as (path, rows) with the headers
+        on the first row, as Editor.process_rows leaves them.
+        The path is only used to find the new_columns_regex.
+        """
+        sources = ((path,
+                    rows[0] if len(rows) > 0 else [],
+                    [row for row in rows[1:] if len(row) > 0])
+                   for path, rows in sheets)
+        self.merge_sources(sources, output)
+
+    def merge_sources(self, sources, output, total=None):
+        """
+        Merges (path, headers, rows) sources
+        Matches them according to the fixed_columns
+        Leaves output csv at output argument
+        """
+        columns = self.fixed_columns[:] + self.merge_columns[:]
+        matcher = easyio.Matcher(columns)
+        data = self.create_store(columns)
+
+        tracker = progress_module.Tracker(self.progress, total)
 
         # For each file
-        for idx, path in enumerate(files):
-            print(str(int(idx * 100 / len(files))) + '%')
-            # Split content in headers and data
-            headers, rows = self.get_headers_and_data(path)
+        for path, headers, rows in sources:
+            count = self.merge_source(path, headers, rows,
+                                      columns, matcher, data)
 
-            # Indices (fixed -> header index)
-            regex_match = self.new_columns_regex.search(path)
-            prepend = regex_match.group() if regex_match else u''
-            indices = self.build_column_indices(headers, columns, prepend)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            tracker.file_done(count, size)
 
-            # print(columns)
-            # For each row of data
-            for row in rows:
-                # Get the data for each column
-                new_data = self.build_data(row, indices, columns)
+        self.write_output(columns, data, output)
+        data.close()
 
-                # Get the unique identifier
-                identifier_data = new_data[0:len(self.fixed_columns)]
-                identifier = easyio.merge(identifier_data, self.separator)
+    def merge_source(self, path, headers, rows, columns, matcher, data):
+        """
+        Merges the rows of one source into data (a store),
+        adding its new columns to columns and matcher
+        Returns the number of rows merged
+        """
+        with self.metrics.stage('merge.index', path=path):
+            indices = self.build_file_indices(path, headers, columns,
+                                              matcher)
+
+        rows = metrics_module.Timed(rows, self.metrics)
+        with self.metrics.stage('merge.merge', path=path) as stage:
+            size = None
+            if self.metrics.enabled and hasattr(data, '__len__'):
+                size = len(data)
+            self.merge_data(rows, indices, columns, data)
+
+            stage.seconds -= rows.seconds
+            stage.rows_in = rows.count
+            if size is not None:
+                stage.rows_out = len(data) - size
+                stage.duplicates = rows.count - stage.rows_out
+
+        stage = self.metrics.stage('merge.parse', path=path)
+        stage.seconds = rows.seconds
+        stage.rows_out = rows.count
+        if os.path.exists(path):
+            stage.bytes_read = os.path.getsize(path)
+        stage.done()
+
+        return rows.count
+
+    def build_file_indices(self, path, headers, columns, matcher):
+        """
+        Gets the column indices for the headers of a file, with the
+        new columns prepended by the match of new_columns_regex on its path
+        """
+        # Indices (fixed -> header index)
+        regex_match = self.new_columns_regex.search(path)
+        prepend = regex_match.group() if regex_match else u''
+        return self.build_column_indices(headers, columns, prepend, matcher)
 
-                if identifier not in data:
-                    data[identifier] = new_data
+    def merge_data(self, rows, indices, columns, data):
+        """
+        Merges rows into data (a store), given the indices of their columns
+        """
+        width = len(columns)
+        fixed_width = len(self.fixed_columns)
+        cells = self.build_cells(indices)
+
+        # For each row of data
+        for row in rows:
+            # Get the non empty values with their column
+            length = len(row)
+            values = [(column, row[i]) for i, column in cells
+                      if i < length and len(row[i]) > 0]
+
+            # Get the unique identifier
+            identifier_data = [u''] * fixed_width
+            for column, value in values:
+                if column < fixed_width:
+                    identifier_data[column] = value
+            identifier = tuple(identifier_data)
+
+            data.update_values(identifier, width, values)
+
+    def build_cells(self, indices):
+        """
+        Gets (file column index, output column index) pairs for all
+        columns with a match, in order of the file columns
+
+        >>> m = Merger()
+        >>> m.build_cells({0: 1, 1: -1, 2: 0})
+        [(0, 1), (2, 0)]
+        """
+        return [(i, indices[i]) for i in sorted(indices) if indices[i] != -1]
+
+    def write_output(self, columns, records, output):
+        """
+        Writes the headers and merged records as CSV to output,
+        one row at a time
+        """
+        lines = metrics_module.Timed(
+            (easyio.merge(record, self.separator) for record in records),
+            self.metrics)
+
+        with self.metrics.stage('merge.write', path=output) as stage:
+            with easyio.Writer(output) as writer:
+                writer.write_row(columns, self.separator)
+
+                for line in lines:
+                    writer.write_line(line)
+
+            stage.seconds -= lines.seconds
+            stage.rows_in = lines.count
+            stage.bytes_written = os.path.getsize(output)
+
+        stage = self.metrics.stage('merge.serialize', path=output)
+        stage.seconds = lines.seconds
+        stage.rows_out = lines.count
+        stage.done()
 
-                else:
-                    if len(new_data) > len(data[identifier]):
-                        data[identifier].extend([u''] *
-                                                (len(new_data) -
-                                                 len(data[identifier])))
-                    for i, x in enumerate(new_data):
-                        if len(x) > 0:
-                            data[identifier][i] = x
 
-        # Build content for CSV
-        lines = []
+# Merger used by the processes of Merger.merge_files_parallel
+_merger = None
 
-        headers = columns[:]
-        lines.append(easyio.merge(headers, self.separator))
 
-        for key in data:
-            lines.append(easyio.merge(data[key], self.separator))
+def _init_worker(merger):
+    global _merger
+    _merger = merger
 
-        content = '\n'.join(lines)
 
-        # Write the CSV file
-        easyio.write_file(output, content)
+def _merge_file(task):
+    return _merger.merge_file(*task)
 
 
 def test():
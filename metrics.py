@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import cProfile
+import io
+import json
+import pstats
+import time
+
+
+class Metrics:
+    """
+    Records what every stage of a run did (wall time, rows in and out,
+    bytes read and written, duplicate identifiers...) and hands every
+    record, as a dictionary, to each of the sinks.
+    A sink is any function taking a record, like a JsonLinesSink.
+
+    With processes (workers), the sinks run in those processes.
+
+    >>> records = []
+    >>> m = Metrics([records.append])
+    >>> with m.stage('edit', path='a.csv') as stage:
+    ...     stage.rows_in = 3
+    >>> records[0]['stage'], records[0]['path'], records[0]['rows_in']
+    ('edit', 'a.csv', 3)
+    """
+    def __init__(self, sinks=[]):
+        self.sinks = list(sinks)
+
+    @property
+    def enabled(self):
+        return len(self.sinks) > 0
+
+    def stage(self, name, **labels):
+        """
+        Gets a Stage to use in a with block, which is timed and
+        recorded at the end of the block
+        """
+        return Stage(self, name, labels)
+
+    def emit(self, record):
+        """
+        Hands a record to every sink
+        """
+        for sink in self.sinks:
+            sink(record)
+
+
+class Stage:
+    """
+    What a stage did. Its counters (and seconds, if it is not used
+    in a with block) are set by the code it measures
+    """
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.duplicates = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, trace):
+        self.seconds += time.time() - self.start
+        if exception_type is None:
+            self.done()
+
+    def done(self):
+        """
+        Records the stage. Only needed for stages timed by hand,
+        outside a with block
+        """
+        if self.metrics.enabled:
+            self.metrics.emit(self.record())
+
+    def record(self):
+        """
+        Gets the stage as a dictionary, without unset counters
+        """
+        record = {'stage': self.name, 'seconds': round(self.seconds, 6)}
+        record.update(self.labels)
+        for key in ['rows_in', 'rows_out', 'bytes_read', 'bytes_written',
+                    'duplicates']:
+            if getattr(self, key) is not None:
+                record[key] = getattr(self, key)
+
+        return record
+
+
+class Timed:
+    """
+    Wraps an iterable, counting the items taken from it, and the time
+    spent getting them when the metrics are enabled
+
+    >>> items = Timed(iter([1, 2, 3]), NULL)
+    >>> list(items), items.count
+    ([1, 2, 3], 3)
+    """
+    def __init__(self, iterable, metrics):
+        self.iterable = iterable
+        self.clock = metrics.enabled
+        self.count = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        if not self.clock:
+            for item in self.iterable:
+                self.count += 1
+                yield item
+            return
+
+        iterator = iter(self.iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.time() - start
+                return
+
+            self.seconds += time.time() - start
+            self.count += 1
+            yield item
+
+
+class JsonLinesSink:
+    """
+    Appends every record to a file, as a line of JSON
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            f.write(unicode(json.dumps(record, ensure_ascii=False)) + u'\n')
+
+
+def profile(output, function, *args, **kwargs):
+    """
+    Runs function under cProfile, saving the stats to output
+    and printing the 20 most expensive calls
+    Returns what function returns
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(output)
+        pstats.Stats(output).sort_stats('cumulative').print_stats(20)
+
+
+# Metrics which record nothing
+NULL = Metrics()
+
+
+def test():
+    print('Testing...')
+    import doctest
+    doctest.testmod()
+    print('Done')
+
+
+if __name__ == '__main__':
+    test()
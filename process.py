@@ -3,10 +3,15 @@
 import splitter
 import merger
 import editor
+import cache
 import easyio
+import json
+import manifest
+import metrics
+import progress
 
 
-def juan_bohon(folders, output):
+def juan_bohon(folders, output, **options):
     fixed_columns = [u'RUT',
                      u'APELLIDO PATERNO',
                      u'APELLIDO MATERNO',
@@ -73,21 +78,64 @@ def juan_bohon(folders, output):
     process(folders, output,
             fixed_columns, merge_columns, ignore_columns,
             remove_content, custom_headers, custom_columns,
-            expect_new_columns, new_columns_regex, separator=u',')
+            expect_new_columns, new_columns_regex, separator=u',',
+            **options)
 
 
 def process(folders, output,
             fixed_columns, merge_columns, ignore_columns,
             remove_content, custom_headers, custom_columns,
-            expect_new_columns, new_columns_regex, separator=u','):
-    ed = editor.Editor()
-    sp = splitter.Splitter(separator)
+            expect_new_columns, new_columns_regex, separator=u',',
+            in_memory=False, debug=False, incremental=False, workers=None,
+            metrics_path=None, cache_directory=None, binary=False):
+    """
+    Splits, edits and merges the excel files on every folder.
+
+    With in_memory, the sheets go straight from the workbooks through
+    the editor into the merger, and only the output is written.
+    The debug flag then also writes the edited csv of every sheet.
+
+    With incremental, only the workbooks which changed since the last run
+    to the same output are split and edited, and the merge only reads the
+    sheets which changed. The csv files are kept for the next run, so it
+    turns off in_memory.
+
+    With workers, the excel files are split, and the csv files edited
+    and merged, in that many processes.
+
+    With a metrics_path, what every stage did is appended to it
+    as JSON lines.
+
+    With a cache_directory, the rows read from every workbook are kept
+    there, and workbooks which did not change are not opened again.
+
+    With binary, the sheets are passed between the stages in
+    easyio.RowsWriter files instead of csv files.
+    """
+    sinks = []
+    if metrics_path is not None:
+        sinks.append(metrics.JsonLinesSink(metrics_path))
+    run_metrics = metrics.Metrics(sinks)
+
+    workbook_cache = None
+    if cache_directory is not None:
+        workbook_cache = cache.WorkbookCache(cache_directory)
+
+    ed = editor.Editor(metrics=run_metrics,
+                       progress=progress.ConsoleReporter())
+    sp = splitter.Splitter(separator,
+                           metrics=run_metrics,
+                           progress=progress.ConsoleReporter(),
+                           cache=workbook_cache,
+                           binary=binary)
     mg = merger.Merger(separator=separator,
                        fixed_columns=fixed_columns,
                        ignore_columns=ignore_columns,
                        merge_columns=merge_columns,
                        expect_new_columns=expect_new_columns,
-                       new_columns_regex=new_columns_regex)
+                       new_columns_regex=new_columns_regex,
+                       incremental=incremental,
+                       metrics=run_metrics)
 
     ed.remove_content_in_processing(remove_content)
     ed.remove_empty_columns_in_processing()
@@ -103,14 +151,101 @@ def process(folders, output,
         fixed_columns, merge_columns, ignore_columns)
 
     for folder in folders:
-        csvs = sp.split_folder(folder)
-        ed.process(folder)
-        mg.merge_folder(folder, output)
-        for files in csvs:
-            easyio.remove(csvs[files])
-
-
-def tryout(folder, output):
+        if in_memory and not incremental:
+            sheets = edit_sheets(sp, ed, folder, debug)
+            mg.merge_rows(sheets, output)
+            continue
+
+        if incremental:
+            settings = [separator, binary, fixed_columns, merge_columns,
+                        ignore_columns, remove_content,
+                        sorted(custom_headers.items()), custom_columns]
+            csvs, kept, workbooks = split_changed(sp, folder, output,
+                                                  settings, workers)
+            ed.skip_files_in_processing(kept)
+        else:
+            csvs = sp.split_folder(folder, workers)
+
+        ed.process(folder, workers)
+        mg.merge_folder(folder, output, workers)
+        if incremental:
+            manifest.write_manifest(output + '.workbooks', workbooks)
+        if not incremental:
+            for files in csvs:
+                easyio.remove(csvs[files])
+
+
+def split_changed(sp, folder, output, settings, workers=None):
+    """
+    Splits the workbooks in folder which changed since the last
+    incremental run to output with the same settings.
+    The workbooks of that run are read from a manifest next to the output,
+    with the sheets they were split into, which are kept as they are
+    for those which did not change.
+
+    Returns {workbook: csv files} for the workbooks split now,
+    the csv files kept, and the manifest to write once the sheets
+    are edited.
+    """
+    manifest_path = output + '.workbooks'
+    # As they read back from the manifest
+    settings = json.loads(json.dumps(settings))
+
+    previous = manifest.read_manifest(manifest_path)
+    if previous is None or previous['settings'] != settings:
+        previous = {'files': []}
+
+    old_entries = dict((entry['path'], entry)
+                       for entry in previous['files'])
+    sheets = dict((manifest.path_key(path), path)
+                  for path in easyio.get_files(
+                      folder, ['.csv', easyio.ROWS_EXTENSION]))
+
+    entries = []
+    changed = []
+    kept = []
+    for path in easyio.get_files(folder, ['.xls', '.xlsx']):
+        key = manifest.path_key(path)
+        old = old_entries.get(key)
+        entry = manifest.file_entry(path, old)
+
+        if old is not None and old['hash'] == entry['hash'] and\
+                all([sheet in sheets for sheet in old['sheets']]):
+            entry['sheets'] = old['sheets']
+            kept.extend([sheets[sheet] for sheet in old['sheets']])
+            entries.append(entry)
+            del old_entries[key]
+        else:
+            changed.append((path, entry))
+
+    # The sheets of workbooks which changed or are gone
+    for old in old_entries.values():
+        easyio.remove([sheets[sheet] for sheet in old['sheets']
+                       if sheet in sheets])
+
+    csvs = sp.split_files([path for path, entry in changed], workers)
+
+    for path, entry in changed:
+        entry['sheets'] = [manifest.path_key(sheet) for sheet in csvs[path]]
+        entries.append(entry)
+
+    return csvs, kept, {'settings': settings, 'files': entries}
+
+
+def edit_sheets(sp, ed, folder, debug=False):
+    """
+    Yields (csv path, rows) for every sheet in the folder
+    after all the editor processing
+    """
+    for path, rows in sp.iter_folder(folder):
+        rows = ed.process_rows(path, list(rows))
+        if debug:
+            ed.write(path, rows)
+
+        yield path, rows
+
+
+def tryout(folder, output, **options):
     fixed_columns = [u'RUT']
     merge_columns = []
     ignore_columns = []
@@ -123,10 +258,11 @@ def tryout(folder, output):
     process(folders, output,
             fixed_columns, merge_columns, ignore_columns,
             remove_content, custom_headers, custom_columns,
-            expect_new_columns, new_columns_regex, separator=u',')
+            expect_new_columns, new_columns_regex, separator=u',',
+            **options)
 
 
-def test(folder, output):
+def test(folder, output, **options):
     fixed_columns = [u'RUT',
                      u'DV',
                      u'PATERNO',
@@ -154,7 +290,8 @@ def test(folder, output):
     process(folders, output,
             fixed_columns, merge_columns, ignore_columns,
             remove_content, custom_headers, custom_columns,
-            expect_new_columns, new_columns_regex, separator=u',')
+            expect_new_columns, new_columns_regex, separator=u',',
+            **options)
 
 
 if __name__ == '__main__':
@@ -196,6 +333,51 @@ if __name__ == '__main__':
                         help='Whether to run the script for TEST data',
                         default=False)
 
+    parser.add_argument('--in_memory',
+                        dest='in_memory',
+                        help='Whether to merge without intermediate csv files',
+                        default=False)
+
+    parser.add_argument('--debug',
+                        dest='debug',
+                        help='Whether to write the intermediate csv files '
+                             'when merging in memory',
+                        default=False)
+
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        help='Whether to merge only the sheets which changed '
+                             'since the last run',
+                        default=False)
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='Number of processes to use',
+                        type=int,
+                        default=None)
+
+    parser.add_argument('--metrics',
+                        dest='metrics',
+                        help='File to append the metrics of every stage to',
+                        default=None)
+
+    parser.add_argument('--cache',
+                        dest='cache',
+                        help='Folder to keep the rows read from every '
+                             'workbook in, to skip reading them again',
+                        default=None)
+
+    parser.add_argument('--binary',
+                        dest='binary',
+                        help='Whether to pass the sheets between the stages '
+                             'in a binary format instead of csv',
+                        default=False)
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        help='File to save a cProfile of the run to',
+                        default=None)
+
     args = parser.parse_args()
     # [c.strip() for c in args.fixed_columns.split(',')]
     # [c.strip() for c in args.ignore.split(',')]
@@ -204,10 +386,21 @@ if __name__ == '__main__':
     output = args.output
 
     if args.juan_bohon:
-        juan_bohon(folders, output)
-
+        run = juan_bohon
     elif args.test:
-        test(folders, output)
-
+        run = test
+    else:
+        run = tryout
+
+    options = {'in_memory': args.in_memory,
+               'debug': args.debug,
+               'incremental': args.incremental,
+               'workers': args.workers,
+               'metrics_path': args.metrics,
+               'cache_directory': args.cache,
+               'binary': args.binary}
+
+    if args.profile:
+        metrics.profile(args.profile, run, folders, output, **options)
     else:
-        tryout(folders, output)
+        run(folders, output, **options)
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import collections
+import sys
+import time
+
+
+# What a progress callback receives
+# rate is in rows per second, eta in seconds (None if unknown)
+Report = collections.namedtuple(
+    'Report', ['done', 'total', 'rows', 'bytes', 'rate', 'eta'])
+
+
+class Tracker:
+    """
+    Counts the files (or sources) done, with their rows and bytes,
+    and calls callback with a Report after each one
+
+    >>> reports = []
+    >>> tracker = Tracker(reports.append, 2)
+    >>> tracker.file_done(rows=10, bytes=100)
+    >>> tracker.file_done(rows=5)
+    >>> [(r.done, r.total, r.rows, r.bytes) for r in reports]
+    [(1, 2, 10, 100), (2, 2, 15, 100)]
+    >>> reports[-1].eta
+    0.0
+    """
+    def __init__(self, callback, total=None):
+        self.callback = callback
+        self.total = total
+        self.done = 0
+        self.rows = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    def file_done(self, rows=0, bytes=0):
+        """
+        Counts a file as done and reports
+        """
+        self.done += 1
+        self.rows += rows
+        self.bytes += bytes
+
+        if self.callback is not None:
+            self.callback(self.report())
+
+    def report(self):
+        """
+        Gets a Report of the progress so far
+        """
+        elapsed = time.time() - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if self.total:
+            eta = elapsed / self.done * (self.total - self.done)
+
+        return Report(self.done, self.total, self.rows, self.bytes, rate, eta)
+
+
+class ConsoleReporter:
+    """
+    Progress callback printing at most one line every interval seconds,
+    and always the last one
+    """
+    def __init__(self, interval=1.0, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.last = None
+
+    def __call__(self, report):
+        now = time.time()
+        last = report.total is not None and report.done >= report.total
+        if not last and self.last is not None and\
+                now - self.last < self.interval:
+            return
+
+        self.last = now
+        self.stream.write(format_report(report) + '\n')
+        self.stream.flush()
+
+
+def format_report(report):
+    """
+    Gets a line describing a Report
+
+    >>> format_report(Report(3, 4, 1200, 2048, 400.0, 75.0))
+    '75% (3/4 files, 1200 rows, 2.0 KB, 400 rows/s, ETA 0:01:15)'
+    >>> format_report(Report(3, None, 1200, 0, 400.0, None))
+    '3 files, 1200 rows, 0.0 KB, 400 rows/s'
+    """
+    details = '%d rows, %.1f KB, %d rows/s' % (
+        report.rows, report.bytes / 1024.0, report.rate)
+
+    if report.total:
+        eta = int(round(report.eta or 0))
+        return '%d%% (%d/%d files, %s, ETA %d:%02d:%02d)' % (
+            report.done * 100 / report.total, report.done, report.total,
+            details, eta // 3600, eta // 60 % 60, eta % 60)
+
+    return '%d files, %s' % (report.done, details)
+
+
+def test():
+    print('Testing...')
+    import doctest
+    doctest.testmod()
+    print('Done')
+
+
+if __name__ == '__main__':
+    test()
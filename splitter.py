@@ -1,54 +1,263 @@
 #!/usr/bin/python
 # -*- coding: utf8 -*-
+import collections
+import datetime
 import easyio
+import itertools
+import metrics as metrics_module
+import multiprocessing
+import os
+import progress as progress_module
+import traceback
 import xlrd
 
+try:
+    import openpyxl
+    from openpyxl.utils.datetime import to_excel
+except ImportError:
+    openpyxl = None
+
 
 class Splitter:
-    def __init__(self, separator=','):
+    def __init__(self, separator=',', metrics=None, progress=None,
+                 cache=None, binary=False):
         """
         Initializes an instance of Splitter with the given separator
+        metrics (a metrics.Metrics) records the splitting of every file
+        progress, if given, is called with a progress.Report
+        after every file
+        cache, a cache.WorkbookCache, keeps the rows read from every
+        workbook, so unchanged workbooks are not opened again
+        With binary, the sheets are written with easyio.RowsWriter
+        instead of as csv files
         """
         self.separator = separator
+        self.metrics = metrics or metrics_module.NULL
+        self.progress = progress
+        self.cache = cache
+        self.binary = binary
+        self.errors = collections.OrderedDict()
 
-    def split_folder(self, path):
+    def __getstate__(self):
         """
-        Transforms all excel sheets into separate csv files
+        Leaves progress out when pickled for the worker processes,
+        as Editor does
+
+        >>> import pickle
+        >>> sp = Splitter(progress=progress_module.ConsoleReporter())
+        >>> pickle.loads(pickle.dumps(sp)).progress is None
+        True
         """
-        files = easyio.get_files(path, ['.xls', '.xlsx'])
+        state = self.__dict__.copy()
+        state['progress'] = None
+        return state
 
-        csv_files = {}
-        for file_path in files:
-            csv_files[file_path] = self.split_file(file_path)
+    def split_folder(self, path, workers=None):
+        """
+        Transforms all excel sheets into separate csv (or rows) files
+
+        With workers, the excel files are read in that many processes.
+        Returns {excel file: [csv files]} in the order the files are found.
+        Errors do not stop the other files. They are kept in errors
+        (path -> traceback), and raised together at the end.
+        """
+        return self.split_files(easyio.get_files(path, ['.xls', '.xlsx']),
+                                workers)
+
+    def split_files(self, files, workers=None):
+        """
+        Transforms all sheets of the given excel files into separate
+        csv (or rows) files, as split_folder does
+        """
+        tracker = progress_module.Tracker(self.progress, len(files))
+
+        pool = None
+        if workers is not None and workers > 1:
+            pool = multiprocessing.Pool(workers, _init_worker, (self,))
+            results = pool.imap(_try_split_file, files)
+        else:
+            results = (self.try_split_file(file_path) for file_path in files)
+
+        csv_files = collections.OrderedDict()
+        self.errors = collections.OrderedDict()
+        try:
+            for idx, (output_file_names, rows, error) in enumerate(results):
+                file_path = files[idx]
+                if error is not None:
+                    self.errors[file_path] = error
+                else:
+                    csv_files[file_path] = output_file_names
+
+                tracker.file_done(rows, os.path.getsize(file_path))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if len(self.errors) > 0:
+            raise RuntimeError('Splitting failed on %d files:\n%s' % (
+                len(self.errors),
+                '\n'.join(['%s\n%s' % (path, error)
+                           for path, error in self.errors.items()])))
 
         return csv_files
 
+    def try_split_file(self, path):
+        """
+        Transforms an excel sheet into separate csv files
+        Returns the csv files, the rows written and None,
+        or None, 0 and the traceback if it fails
+        """
+        try:
+            output_file_names, rows = self.split_file(path)
+            return output_file_names, rows, None
+        except Exception:
+            return None, 0, traceback.format_exc()
+
     def split_file(self, path):
         """
         Transforms an excel sheet into separate csv files
+        Returns the csv files and the number of rows written to them.
+        If it fails, the files already written for it are removed
         """
-        wb = xlrd.open_workbook(path)
-        sheet_names = wb.sheet_names()
         output_file_names = []
 
-        for i in range(len(sheet_names)):
-            sheet = wb.sheet_by_index(i)
-            nrows = sheet.nrows
-            lines = []
+        with self.metrics.stage('split', path=path) as stage:
+            stage.bytes_read = os.path.getsize(path)
+            stage.rows_out = 0
+            stage.bytes_written = 0
+
+            try:
+                for csv_path, rows in self.iter_sheets(path):
+                    with easyio.open_writer(csv_path) as writer:
+                        for row in rows:
+                            writer.write_row(row, self.separator)
+
+                    output_file_names.append(csv_path)
+                    stage.rows_out += writer.lines
+                    stage.bytes_written += os.path.getsize(csv_path)
+            except Exception:
+                easyio.remove(output_file_names)
+                raise
+
+        return output_file_names, stage.rows_out
+
+    def iter_folder(self, path):
+        """
+        Yields (csv path, rows) for every sheet of every excel file
+        in a folder, without writing any file
+        """
+        for file_path in easyio.get_files(path, ['.xls', '.xlsx']):
+            for sheet in self.iter_sheets(file_path):
+                yield sheet
+
+    def iter_sheets(self, path):
+        """
+        Yields (csv path, rows) for every non empty sheet of an excel file.
+        The csv path is where split_file would write the sheet.
+
+        The rows are read one at a time, and every sheet is unloaded once
+        the next one is asked for, so the rows of a sheet must be used
+        before moving on to the next one.
+
+        With a cache, the rows of a workbook already read come from it.
+        """
+        reader = self.reader(path)
+        if self.cache is None:
+            sheets = reader(path)
+        else:
+            key = self.cache.key(path, reader.__name__)
+            sheets = self.cache.read(key)
+            if sheets is None:
+                sheets = self.cache.write(key, reader(path))
+
+        return ((self.sheet_path(path, i), rows) for i, rows in sheets)
+
+    def reader(self, path):
+        """
+        Gets the method yielding (sheet index, rows) for a workbook
+        """
+        if openpyxl is not None and easyio.get_extension(path) == '.xlsx':
+            return self._iter_xlsx_sheets
+
+        return self._iter_xls_sheets
+
+    def _iter_xls_sheets(self, path):
+        wb = xlrd.open_workbook(path, on_demand=True)
+        try:
+            for i in range(wb.nsheets):
+                sheet = wb.sheet_by_index(i)
+                if sheet.nrows > 0:
+                    yield i, _iter_xls_rows(sheet)
+
+                wb.unload_sheet(i)
+        finally:
+            wb.release_resources()
+
+    def _iter_xlsx_sheets(self, path):
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for i, sheet in enumerate(wb.worksheets):
+                rows = _iter_xlsx_rows(sheet)
+                first = next(rows, None)
+                if first is not None:
+                    yield i, itertools.chain([first], rows)
+        finally:
+            wb.close()
+
+    def sheet_path(self, path, index):
+        """
+        Gets the csv path for the sheet of an excel file.
+        With binary, easyio.ROWS_EXTENSION is added to it, so the csv
+        name is still there for patterns looking for it.
+
+        >>> Splitter().sheet_path('files/CUR12015.xlsx', 2)
+        'files/CUR12015 - 2.csv'
+        >>> Splitter(binary=True).sheet_path('files/CUR12015.xlsx', 2)
+        'files/CUR12015 - 2.csv.rows'
+        """
+        path = path.\
+            replace('.xlsx', ' - %s.csv' % index).\
+            replace('.xls', ' - %s.csv' % index)
+
+        if self.binary:
+            path += easyio.ROWS_EXTENSION
+
+        return path
+
+
+def _iter_xls_rows(sheet):
+    for j in range(sheet.nrows):
+        yield [unicode(value) for value in sheet.row_values(j)]
+
+
+def _iter_xlsx_rows(sheet):
+    for row in sheet.iter_rows():
+        yield [_xlsx_value(cell.value) for cell in row]
+
+
+def _xlsx_value(value):
+    # Writes values the way xlrd gives them: numbers and dates as floats
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return unicode(int(value))
+    if isinstance(value, (int, long)):
+        return unicode(float(value))
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return unicode(float(to_excel(value)))
+
+    return unicode(value)
+
 
-            for j in range(nrows):
-                row = sheet.row(j)
-                data = ['"%s"' % unicode(cell.value) for cell in row]
-                lines.append(self.separator.join(data))
+# Splitter used by the processes of Splitter.split_folder
+_splitter = None
 
-            content = '\n'.join(lines)
 
-            if len(content) > 0:
-                csv_path = path.\
-                    replace('.xlsx', ' - %s.csv' % i).\
-                    replace('.xls', ' - %s.csv' % i)
+def _init_worker(splitter):
+    global _splitter
+    _splitter = splitter
 
-                easyio.write_file(csv_path, content)
-                output_file_names.append(csv_path)
 
-        return output_file_names
+def _try_split_file(path):
+    return _splitter.try_split_file(path)
@@ -0,0 +1,494 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+import heapq
+import itertools
+import marshal
+import operator
+import os
+import sqlite3
+import tempfile
+
+
+def dense(width, values):
+    """
+    Gets a record of the given width from (column, value) pairs
+
+    >>> dense(3, [(2, u'b'), (0, u'a')])
+    [u'a', u'', u'b']
+    """
+    record = [u''] * width
+    for column, value in values:
+        record[column] = value
+
+    return record
+
+
+def overlay(record, new_data):
+    """
+    Writes the non empty values of new_data over record,
+    expanding it if need be
+
+    >>> record = [u'1', u'a', u'']
+    >>> overlay(record, [u'1', u'', u'b', u'c'])
+    [u'1', u'a', u'b', u'c']
+    """
+    if len(new_data) > len(record):
+        record.extend([u''] * (len(new_data) - len(record)))
+
+    for i, x in enumerate(new_data):
+        if len(x) > 0:
+            record[i] = x
+
+    return record
+
+
+class DictStore:
+    """
+    Keeps every merged record in memory, by identifier,
+    in data if given (to use an OrderedDict, for instance)
+    """
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+
+    def update(self, identifier, new_data):
+        """
+        Merges new_data into the record for the identifier
+        """
+        if identifier not in self.data:
+            self.data[identifier] = new_data
+        else:
+            overlay(self.data[identifier], new_data)
+
+    def update_values(self, identifier, width, values):
+        """
+        Writes the (column, value) pairs into the record for the identifier,
+        which has at least the given width.
+        Only the given columns are touched.
+        """
+        record = self.data.get(identifier)
+        if record is None:
+            record = self.data[identifier] = [u''] * width
+        elif len(record) < width:
+            record.extend([u''] * (width - len(record)))
+
+        for column, value in values:
+            record[column] = value
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for key in self.data:
+            yield self.data[key]
+
+    def close(self):
+        self.data = {}
+
+
+class PackedStore:
+    """
+    Keeps every merged record in memory, by identifier, as a single
+    marshal string of its values rather than a list of unicode objects,
+    which takes a fraction of the memory.
+    Uses data as the dictionary if given (to use an OrderedDict, for instance)
+
+    Records are unpacked to be updated or iterated, so every update
+    takes time in proportion to the width of the record: DictStore is
+    faster when memory is not short.
+
+    >>> store = PackedStore()
+    >>> store.update_values((u'1',), 3, [(0, u'1'), (2, u'a')])
+    >>> store.update_values((u'1',), 4, [(3, u'b')])
+    >>> store.update((u'2',), [u'2', u'c'])
+    >>> type(store.data[(u'1',)])
+    <type 'str'>
+    >>> sorted(store)
+    [[u'1', u'', u'a', u'b'], [u'2', u'c']]
+    """
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+
+    def update(self, identifier, new_data):
+        """
+        Merges new_data into the record for the identifier
+        """
+        packed = self.data.get(identifier)
+        if packed is None:
+            self.data[identifier] = marshal.dumps(tuple(new_data))
+        else:
+            record = overlay(list(marshal.loads(packed)), new_data)
+            self.data[identifier] = marshal.dumps(tuple(record))
+
+    def update_values(self, identifier, width, values):
+        """
+        Writes the (column, value) pairs into the record for the identifier,
+        which has at least the given width
+        """
+        packed = self.data.get(identifier)
+        if packed is None:
+            record = dense(width, values)
+        else:
+            record = list(marshal.loads(packed))
+            if len(record) < width:
+                record.extend([u''] * (width - len(record)))
+
+            for column, value in values:
+                record[column] = value
+
+        self.data[identifier] = marshal.dumps(tuple(record))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for key in self.data:
+            yield list(marshal.loads(self.data[key]))
+
+    def close(self):
+        self.data = {}
+
+
+class SparseStore:
+    """
+    Keeps every merged record in memory, by identifier, as its width
+    and a dictionary (column -> value) of its non empty values only.
+    Records are only made dense when iterated.
+    Uses data as the dictionary if given (to use an OrderedDict, for instance)
+
+    >>> store = SparseStore()
+    >>> store.update_values(u'1', 3, [(0, u'1'), (2, u'a')])
+    >>> store.update_values(u'1', 5, [(0, u'1'), (3, u'b')])
+    >>> store.data[u'1']
+    [5, {0: u'1', 2: u'a', 3: u'b'}]
+    >>> list(store)
+    [[u'1', u'', u'a', u'b', u'']]
+    """
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+
+    def update(self, identifier, new_data):
+        """
+        Merges new_data into the record for the identifier
+        """
+        values = [(i, x) for i, x in enumerate(new_data) if len(x) > 0]
+        self.update_values(identifier, len(new_data), values)
+
+    def update_values(self, identifier, width, values):
+        """
+        Writes the (column, value) pairs into the record for the identifier,
+        which has at least the given width
+        """
+        entry = self.data.get(identifier)
+        if entry is None:
+            self.data[identifier] = [width, dict(values)]
+        else:
+            if entry[0] < width:
+                entry[0] = width
+            entry[1].update(values)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for key in self.data:
+            width, values = self.data[key]
+            yield dense(width, values.items())
+
+    def close(self):
+        self.data = {}
+
+
+class SpillStore:
+    """
+    Keeps merged records in memory until their estimated size goes over
+    memory_budget (in bytes). They are then written, sorted by identifier,
+    to a run file in directory and forgotten.
+
+    Iterating does a k-way merge of the runs by identifier, where later
+    runs win, so the records come out sorted by identifier (as they do
+    when nothing was spilled). At most fan_in runs are open at a time:
+    with more, the oldest ones are first merged into a single run.
+
+    >>> store = SpillStore(1)
+    >>> store.update(u'b', [u'b', u'1', u''])
+    >>> store.update(u'a', [u'a', u'', u'2'])
+    >>> store.update(u'b', [u'b', u'', u'3'])
+    >>> len(store.runs)
+    3
+    >>> list(store)
+    [[u'a', u'', u'2'], [u'b', u'1', u'3']]
+    >>> store.close()
+
+    >>> store = SpillStore(1, fan_in=2)
+    >>> for i in range(5):
+    ...     store.update(u'a', [u'a', unicode(i)])
+    >>> list(store), len(store.runs)
+    ([[u'a', u'4']], 2)
+    >>> store.close()
+    """
+    def __init__(self, memory_budget, directory=None, fan_in=64):
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.fan_in = fan_in
+        self.data = {}
+        self.size = 0
+        self.runs = []
+
+    def update(self, identifier, new_data):
+        """
+        Merges new_data into the record for the identifier,
+        spilling to disk when over budget
+        """
+        if identifier not in self.data:
+            self.data[identifier] = new_data
+            self.size += _estimate_size(identifier) + _estimate_size(new_data)
+        else:
+            overlay(self.data[identifier], new_data)
+            self.size += _estimate_size(new_data)
+
+        if self.size > self.memory_budget:
+            self.spill()
+
+    def update_values(self, identifier, width, values):
+        """
+        Writes the (column, value) pairs into the record for the identifier,
+        which has at least the given width
+        """
+        self.update(identifier, dense(width, values))
+
+    def spill(self):
+        """
+        Writes the records in memory to a new run file
+        """
+        if len(self.data) == 0:
+            return
+
+        self.runs.append(self._write_run(
+            (identifier, self.data[identifier])
+            for identifier in sorted(self.data)))
+        self.data = {}
+        self.size = 0
+
+    def _write_run(self, records):
+        handle, path = tempfile.mkstemp(suffix='.run', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f:
+            for record in records:
+                marshal.dump(record, f)
+
+        return path
+
+    def __iter__(self):
+        if len(self.runs) == 0:
+            for identifier in sorted(self.data):
+                yield self.data[identifier]
+            return
+
+        self.spill()
+
+        # The oldest runs are merged first, so later runs still win
+        while len(self.runs) > self.fan_in:
+            batch = self.runs[:self.fan_in]
+            merged = self._write_run(_merge_runs(batch))
+            for path in batch:
+                os.remove(path)
+            self.runs = [merged] + self.runs[self.fan_in:]
+
+        for identifier, record in _merge_runs(self.runs):
+            yield record
+
+    def close(self):
+        """
+        Removes the run files
+        """
+        for path in self.runs:
+            os.remove(path)
+
+        self.runs = []
+        self.data = {}
+        self.size = 0
+
+
+class SqliteStore:
+    """
+    Keeps merged records in a SQLite database at path, with one row
+    per identifier (and its width) in the rows table, and one row per
+    non empty value in the cells table.
+    The column names are kept in the columns table.
+
+    Updates are buffered and written batch_size at a time,
+    each batch in its own transaction, touching only the given values.
+    Iterating gives the records in order of first appearance.
+
+    >>> columns = [u'ID', u'A']
+    >>> store = SqliteStore(':memory:', columns)
+    >>> store.update(u'1', [u'1', u'x'])
+    >>> columns.append(u'B')
+    >>> store.update(u'2', [u'2', u'', u'y'])
+    >>> store.update(u'1', [u'1', u'', u'z'])
+    >>> list(store)
+    [[u'1', u'x', u'z'], [u'2', u'', u'y']]
+    >>> store.close()
+    """
+    def __init__(self, path, columns, batch_size=1000):
+        self.connection = sqlite3.connect(path)
+        self.columns = columns
+        self.batch_size = batch_size
+        self.batch = []
+        self.width = 0
+
+        with self.connection:
+            for table in ['rows', 'cells', 'columns']:
+                self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+
+            self.connection.execute(
+                'CREATE TABLE rows (identifier TEXT PRIMARY KEY, '
+                'width INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE cells (identifier TEXT NOT NULL, '
+                'position INTEGER NOT NULL, value TEXT NOT NULL, '
+                'PRIMARY KEY (identifier, position))')
+            self.connection.execute(
+                'CREATE TABLE columns (position INTEGER PRIMARY KEY, '
+                'name TEXT NOT NULL)')
+
+    def update(self, identifier, new_data):
+        """
+        Merges new_data into the record for the identifier
+        """
+        values = [(i, x) for i, x in enumerate(new_data) if len(x) > 0]
+        self.update_values(identifier, len(new_data), values)
+
+    def update_values(self, identifier, width, values):
+        """
+        Writes the (column, value) pairs into the record for the identifier,
+        which has at least the given width.
+        Empty values leave the stored ones as they are.
+        """
+        self.batch.append((_key(identifier), width, values))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending updates in one transaction
+        """
+        if len(self.batch) == 0:
+            return
+
+        width = max([width for identifier, width, values in self.batch])
+
+        with self.connection:
+            self._add_columns(width)
+
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO rows (identifier, width) '
+                'VALUES (?, 0)',
+                [(identifier,) for identifier, width, values in self.batch])
+            self.connection.executemany(
+                'UPDATE rows SET width = MAX(width, ?) WHERE identifier = ?',
+                [(width, identifier)
+                 for identifier, width, values in self.batch])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO cells (identifier, position, value) '
+                'VALUES (?, ?, ?)',
+                [(identifier, column, value)
+                 for identifier, width, values in self.batch
+                 for column, value in values if len(value) > 0])
+
+        self.batch = []
+
+    def _add_columns(self, width):
+        self.connection.executemany(
+            'INSERT INTO columns (position, name) VALUES (?, ?)',
+            [(i, self.columns[i] if i < len(self.columns) else u'')
+             for i in range(self.width, width)])
+
+        self.width = max(self.width, width)
+
+    def __len__(self):
+        self.flush()
+        cursor = self.connection.execute('SELECT COUNT(*) FROM rows')
+        return cursor.fetchone()[0]
+
+    def __iter__(self):
+        self.flush()
+
+        cursor = self.connection.execute(
+            'SELECT rows.identifier, rows.width, cells.position, cells.value '
+            'FROM rows LEFT JOIN cells ON cells.identifier = rows.identifier '
+            'ORDER BY rows.rowid, cells.position')
+
+        groups = itertools.groupby(cursor, operator.itemgetter(0))
+        for identifier, group in groups:
+            record = None
+            for identifier, width, column, value in group:
+                if record is None:
+                    record = [u''] * width
+                if column is not None:
+                    record[column] = value
+
+            yield record
+
+    def close(self):
+        """
+        Writes the pending updates and closes the database
+        """
+        self.flush()
+        self.connection.close()
+
+
+def _key(identifier):
+    # Text key for a tuple identifier
+    if isinstance(identifier, tuple):
+        return u'\x1f'.join(identifier)
+
+    return identifier
+
+
+def _merge_runs(paths):
+    # Yields (identifier, record) from sorted runs, by identifier,
+    # with the records of later runs written over earlier ones
+    runs = [_read_run(path, i) for i, path in enumerate(paths)]
+    current = None
+    record = None
+    for identifier, i, new_data in heapq.merge(*runs):
+        if identifier != current:
+            if record is not None:
+                yield current, record
+            current = identifier
+            record = new_data
+        else:
+            overlay(record, new_data)
+
+    if record is not None:
+        yield current, record
+
+
+def _read_run(path, index):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                identifier, record = marshal.load(f)
+            except EOFError:
+                return
+
+            yield identifier, index, record
+
+
+def _estimate_size(data):
+    # Rough size in bytes of a list, tuple or string and its contents
+    if isinstance(data, (list, tuple)):
+        return 64 + sum([56 + 4 * len(x) for x in data])
+
+    return 56 + 4 * len(data)
+
+
+def test():
+    print('Testing...')
+    import doctest
+    doctest.testmod()
+    print('Done')
+
+
+if __name__ == '__main__':
+    test()